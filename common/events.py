@@ -0,0 +1,49 @@
+"""
+In-process publish/subscribe for readings that need to reach other
+components as soon as they are produced rather than on their next poll.
+
+Handlers run synchronously on the publishing thread, so they must be quick
+and must not block; a handler that raises is logged and does not affect the
+publisher or the other handlers.
+"""
+import logging
+from collections import namedtuple
+from threading import Lock
+
+from common import metrics
+
+# published by CameraDetection for every processed frame, pressure is None when
+# the gauge could not be read; timestamp is the frame's device timestamp
+GAUGE_READING = "gauge_reading"
+GaugeReading = namedtuple("GaugeReading", ["pressure", "timestamp"])
+
+HANDLER_ERRORS = metrics.counter("event_handler_errors_total", "Event handlers that raised", ["topic"])
+
+
+class EventBus:
+    def __init__(self):
+        self.lock = Lock()
+        self.handlers = {}
+
+    def subscribe(self, topic, handler):
+        with self.lock:
+            # replaced rather than appended to, publish() iterates without the lock
+            self.handlers[topic] = self.handlers.get(topic, ()) + (handler,)
+
+    def unsubscribe(self, topic, handler):
+        with self.lock:
+            self.handlers[topic] = tuple(h for h in self.handlers.get(topic, ()) if h is not handler)
+
+    def publish(self, topic, event):
+        for handler in self.handlers.get(topic, ()):
+            try:
+                handler(event)
+            except Exception as e:
+                HANDLER_ERRORS.labels(topic).inc()
+                logging.error("Handler for %s failed: %s", topic, e)
+
+
+BUS = EventBus()
+subscribe = BUS.subscribe
+unsubscribe = BUS.unsubscribe
+publish = BUS.publish
@@ -1,7 +1,7 @@
 import time
 import logging
 import subprocess
-from threading import Lock
+from threading import Lock, Condition
 
 # Import your modules
 import colorsys
@@ -9,14 +9,25 @@ from st7735 import ST7735
 from ltr559 import LTR559
 from bme280 import BME280
 from fonts.ttf import RobotoMedium as UserFont
-from enviroplus import gas
 from PIL import Image, ImageDraw, ImageFont
 from target_acquisition.camera_detection import CameraDetection
+from common import metrics
 import RPi.GPIO as GPIO
 import atexit
 
 FRAME_RATE = 15
 
+FRAMES_PUBLISHED = metrics.counter("video_feed_frames_total", "Frames published to the video feed")
+PUBLISH_LATENCY = metrics.histogram("video_feed_publish_latency_seconds", "Device timestamp to video feed publish latency")
+FRAME_AGE = metrics.gauge("video_feed_frame_age_seconds", "Age of the frame currently in the video feed")
+VIEWERS = metrics.gauge("video_feed_viewers", "Consumers currently watching the video feed")
+
+FRAME_TIMEOUT = 1  # seconds to wait for a camera frame before checking again
+ERROR_DELAY = 1/20  # seconds
+
+# how long a one-off frame request (e.g. a snapshot) keeps frames annotated
+DEMAND_TIMEOUT = 5  # seconds
+
 def cleanup_gpio():
     GPIO.cleanup()
 
@@ -78,64 +89,111 @@ def display_text(st7735_display, values, variable, data, unit):
     draw.text((0, 0), message, font=font, fill=(0, 0, 0))
     st7735_display.display(img)
 
-# Function to get sensor data
-def get_data(bme280, ltr559):
-    # get global variables
-    try:
-        factor = 2.25
-        cpu_temp = get_cpu_temperature()
-        raw_temp = bme280.get_temperature()
-        temp = raw_temp - ((cpu_temp - raw_temp) / factor)
-        pressure = bme280.get_pressure()
-        humidity = bme280.get_humidity()
-        light = ltr559.get_lux()
-        gas_data = gas.read_all()
-        gas_oxidising = gas_data.oxidising / 1000
-        gas_reducing = gas_data.reducing / 1000
-        gas_nh3 = gas_data.nh3 / 1000
-        return {
-            "temperature": temp,
-            "pressure": pressure,
-            "humidity": humidity,
-            "light": light,
-            "oxidised": gas_oxidising,
-            "reduced": gas_reducing,
-            "nh3": gas_nh3
-        }
-    except Exception as e:
-        logging.error("Failed to get sensor data, error: %s", e)
-    
 class VideoFeed:
     def __init__(self):
         self.lock = Lock()
+        self.new_frame = Condition(self.lock)
         self.frame = None
         self.details = {}
+        # incremented on every update so consumers can tell frames apart
+        self.seq = 0
+        self.updated = None
+        # consumers that need annotated frames (browsers on /video, the LCD in camera mode)
+        self.viewers = 0
+        self.demand_until = 0
+        # called with the new seq after each update, from the camera thread
+        self.listeners = []
 
     def update(self, frame, details):
         with self.lock:
             self.frame = frame
             self.details = details
+            self.seq += 1
+            self.updated = time.monotonic()
+            self.new_frame.notify_all()
+            seq = self.seq
+        for listener in self.listeners:
+            listener(seq)
+
+    def add_listener(self, listener):
+        """
+        Call listener(seq) on every update, e.g. to wake an event loop. It runs on
+        the camera thread so it must not block.
+        """
+        self.listeners.append(listener)
+
+    def add_viewer(self):
+        with self.lock:
+            self.viewers += 1
+
+    def remove_viewer(self):
+        with self.lock:
+            self.viewers = max(self.viewers - 1, 0)
+
+    def request_frames(self, duration=DEMAND_TIMEOUT):
+        """
+        Keep frames annotated for a while for consumers that do not stay connected.
+        """
+        self.demand_until = max(self.demand_until, time.monotonic() + duration)
+
+    def has_viewers(self):
+        return self.viewers > 0 or time.monotonic() < self.demand_until
+
+    def frame_age(self):
+        """
+        Seconds since the last update, None if there has not been one.
+        """
+        updated = self.updated
+        if updated is None:
+            return None
+        return time.monotonic() - updated
 
     def get_frame(self):
         with self.lock:
             return self.frame
+
+    def wait_for_frame(self, last_seq, timeout=None):
+        """
+        Block until a frame newer than last_seq is available (or the timeout expires).
+        Returns (seq, frame) for the latest frame.
+        """
+        with self.lock:
+            self.new_frame.wait_for(lambda: self.seq > last_seq, timeout)
+            return self.seq, self.frame
     
     def get_details(self):
         with self.lock:
             return self.details
 
 # video feed thread - constantly updates the video feed
-def video_feed_loop(video_feed):
-    camera = CameraDetection()
+# poll_interval=None blocks on the camera queues and handles each frame as soon as it lands,
+# otherwise the camera is polled every poll_interval seconds
+def video_feed_loop(video_feed, source=None, record_path=None, poll_interval=None):
+    camera = CameraDetection(source=source, record_path=record_path)
+    # writes out a recording in progress
+    atexit.register(camera.close)
+    FRAME_AGE.set_function(video_feed.frame_age)
+    VIEWERS.set_function(lambda: video_feed.viewers)
     logging.info("Starting video feed thread.")
     while True:
         try:
-            image, details = camera.get_frame(rgb_only=False)
-            if image:
-                video_feed.update(image, details)
+            # only draw on the frames when someone is looking at them, details are always produced
+            frame, details = camera.get_frame(
+                rgb_only=not video_feed.has_viewers(),
+                timeout=FRAME_TIMEOUT if poll_interval is None else None
+            )
+            if frame:
+                video_feed.update(frame, details)
+                FRAMES_PUBLISHED.inc()
+                now = camera.clock()
+                if now is not None and details.get("timestamp") is not None:
+                    PUBLISH_LATENCY.observe(now - details["timestamp"])
         except Exception as e:
             logging.error("Video feed error: %s", e)
-        time.sleep(1/20)
+            # don't spin on a persistent error
+            time.sleep(ERROR_DELAY)
+        if poll_interval is not None:
+            time.sleep(poll_interval)
     
 def write_ip_address(display, ip_address):
     WIDTH, HEIGHT = display.width, display.height
@@ -200,42 +258,45 @@ def write_ip_address(display, ip_address):
     return message
 
 # Display thread function
-def display_loop(st7735_display, bme280, ltr559, video_feed):
+def display_loop(st7735_display, sensors, video_feed):
 
     logging.info("Starting display loop.")
 
     WIDTH, HEIGHT = st7735_display.width, st7735_display.height
-    factor = 2.25
     mode = 2
     last_page = 0
     delay = 0.2
     values = {"temperature": [1] * WIDTH}
-    cpu_temps = [get_cpu_temperature()] * 5
     ip_address = None
+    last_seq = 0
+    watching = False
     
     while True:
-        try:
-            proximity = ltr559.get_proximity()
-        except Exception as e:
-            logging.error("Failed to get proximity, error: %s", e)
-            proximity = 0
+        # readings come from the sensor service, the display never touches the bus
+        reading = sensors.latest()
+        proximity = reading.proximity or 0
         current_time = time.time()
         
         if proximity > 1500 and (current_time - last_page) > delay:
             logging.info("Changing Mode")
             mode = (mode + 1) % 3
             last_page = current_time
+            # redraw the camera frame when coming back to camera mode
+            last_seq = 0
+        # the LCD only needs annotated camera frames while in camera mode
+        if (mode == 2) != watching:
+            watching = mode == 2
+            if watching:
+                video_feed.add_viewer()
+            else:
+                video_feed.remove_viewer()
         try: 
             if mode == 0:
                 # variable = "temperature"
                 unit = "°C"
-                cpu_temp = get_cpu_temperature()
-                # Smooth out with some averaging to decrease jitter
-                cpu_temps = cpu_temps[1:] + [cpu_temp]
-                avg_cpu_temp = sum(cpu_temps) / float(len(cpu_temps))
-                raw_temp = bme280.get_temperature()
-                data = raw_temp - ((avg_cpu_temp - raw_temp) / factor)
-                display_text(st7735_display, values, "temperature", data, unit)
+                # compensated for the CPU heating the sensor, see SensorService
+                if reading.temperature is not None:
+                    display_text(st7735_display, values, "temperature", reading.temperature, unit)
             
             elif mode == 1:
                 # IP address mode
@@ -261,10 +322,10 @@ def display_loop(st7735_display, bme280, ltr559, video_feed):
             
             elif mode == 2:
                 # Camera mode
-                frame = video_feed.get_frame()
-                if frame:
-                    image = frame.resize((WIDTH, HEIGHT))
-                    st7735_display.display(image)
+                seq, frame = video_feed.wait_for_frame(last_seq, 0)
+                if frame and seq != last_seq:
+                    last_seq = seq
+                    st7735_display.display(frame.resized((WIDTH, HEIGHT)))
         except Exception as e:
             logging.error("Failed to display data, error: %s", e)
         time.sleep(0.1)
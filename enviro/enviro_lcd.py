@@ -175,11 +175,10 @@ def main():
 
         if mode == 2:
             # try:
-            image, details = camera.get_frame(rgb_only=False)
+            frame, details = camera.get_frame(rgb_only=False)
             # Resize the image to fit the LCD screen
-            if image:
-                image = image.resize((WIDTH, HEIGHT))
-                st7735.display(image)
+            if frame:
+                st7735.display(frame.resized((WIDTH, HEIGHT)))
             # except Exception as e:
             #     if e == KeyboardInterrupt:
             #         sys.exit()
@@ -0,0 +1,254 @@
+import time
+import logging
+from collections import namedtuple
+from threading import Thread, Event, Lock
+
+import numpy as np
+from enviroplus import gas
+from enviro.enviro import get_cpu_temperature
+from common import metrics
+
+# reads per second for each group of readings
+BME280_RATE = 1
+LTR559_RATE = 10  # proximity drives the LCD page changes
+GAS_RATE = 1
+CPU_RATE = 1
+
+# oversampling mode, as fast as each part usefully goes
+OVERSAMPLE_RATES = {
+    "bme280": 10,  # the BME280 takes ~10 ms per forced measurement with the library's settings
+    "ltr559": 10,  # bounded by the LTR559's 100 ms default integration time
+    "gas": 20,  # the gas sensor's ADC converts much faster, I2C reads are the limit
+    "cpu": CPU_RATE,
+}
+
+# readings aggregated between collect() calls, the enviro columns of a telemetry row
+WINDOW_FIELDS = ("temperature", "pressure", "humidity", "light", "oxidised", "reduced", "nh3")
+
+TEMPERATURE_FACTOR = 2.25  # how strongly the CPU heats the BME280
+CPU_SMOOTHING = 5  # CPU temperature readings averaged for the compensation
+
+SENSOR_READ_SECONDS = metrics.histogram("sensor_read_seconds", "Time to read a group of sensors", ["group"])
+SENSOR_ERRORS = metrics.counter("sensor_read_errors_total", "Failed sensor reads", ["group"])
+
+
+_Fields = namedtuple("SensorSnapshot", [
+    "temperature",
+    "raw_temperature",
+    "cpu_temperature",
+    "pressure",
+    "humidity",
+    "light",
+    "proximity",
+    "oxidised",
+    "reduced",
+    "nh3",
+    "updated",
+], defaults=[None] * 11)
+
+
+class SensorSnapshot(_Fields):
+    """
+    Latest value of every reading, immutable. updated is the time.time() of the
+    last read that changed it.
+    """
+
+    __slots__ = ()
+
+    def enviro(self):
+        """
+        The readings stored per telemetry row, by column.
+        """
+        return {
+            "temperature": self.temperature,
+            "pressure": self.pressure,
+            "humidity": self.humidity,
+            "light": self.light,
+            "oxidised": self.oxidised,
+            "reduced": self.reduced,
+            "nh3": self.nh3,
+        }
+
+
+class WindowStats:
+    """
+    Running min/max/mean/standard deviation of each field over a window.
+
+    Every statistic lives in a preallocated array with one slot per field,
+    and adding a sample is a constant number of updates (Welford's method
+    for the mean and variance), however many samples the window holds.
+    """
+
+    def __init__(self, fields=WINDOW_FIELDS):
+        self.fields = tuple(fields)
+        self.index = {field: i for i, field in enumerate(self.fields)}
+        size = len(self.fields)
+        self.count = np.zeros(size, dtype=np.int64)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)  # sum of squared differences from the mean
+        self.min = np.zeros(size)
+        self.max = np.zeros(size)
+        self.reset()
+
+    def reset(self):
+        self.count.fill(0)
+        self.mean.fill(0)
+        self.m2.fill(0)
+        self.min.fill(np.inf)
+        self.max.fill(-np.inf)
+
+    def add(self, field, value):
+        i = self.index.get(field)
+        if i is None or value is None:
+            return
+        count = self.count[i] + 1
+        delta = value - self.mean[i]
+        mean = self.mean[i] + delta / count
+        self.count[i] = count
+        self.mean[i] = mean
+        self.m2[i] += delta * (value - mean)
+        if value < self.min[i]:
+            self.min[i] = value
+        if value > self.max[i]:
+            self.max[i] = value
+
+    def result(self):
+        """
+        {field: {"n", "min", "max", "mean", "std"}} for fields with samples.
+        """
+        stats = {}
+        for i, field in enumerate(self.fields):
+            count = int(self.count[i])
+            if not count:
+                continue
+            stats[field] = {
+                "n": count,
+                "min": float(self.min[i]),
+                "max": float(self.max[i]),
+                "mean": float(self.mean[i]),
+                "std": float(np.sqrt(self.m2[i] / count)),
+            }
+        return stats
+
+
+class SensorService:
+    """
+    The only code that talks to the enviro sensors.
+
+    One thread reads each group of sensors at its own rate and publishes a new
+    SensorSnapshot after every read. As the reads all happen on this thread, I2C
+    transactions never overlap, and consumers (the sampling loop, the LCD) read
+    the latest snapshot from memory without a lock or touching the bus.
+
+    Every reading also goes into WindowStats, which collect() hands over and
+    restarts, so the sampling loop gets aggregates over everything read since
+    its previous row. With oversample=True the sensors are read at
+    OVERSAMPLE_RATES, catching spikes between rows without storing more rows.
+    """
+
+    def __init__(self, bme280, ltr559, gas_sensor=gas, rates=None, oversample=False):
+        self.bme280 = bme280
+        self.ltr559 = ltr559
+        self.gas = gas_sensor
+        defaults = OVERSAMPLE_RATES if oversample else {"bme280": BME280_RATE, "ltr559": LTR559_RATE, "gas": GAS_RATE, "cpu": CPU_RATE}
+        rates = {**defaults, **(rates or {})}
+        # group -> (seconds between reads, read function returning the changed fields)
+        self.groups = {
+            "cpu": (1 / rates["cpu"], self._read_cpu),
+            "bme280": (1 / rates["bme280"], self._read_bme280),
+            "ltr559": (1 / rates["ltr559"], self._read_ltr559),
+            "gas": (1 / rates["gas"], self._read_gas),
+        }
+        self.cpu_temperatures = []
+        self.snapshot = SensorSnapshot()
+        # the sensor thread adds to one window while the other is being read by collect()
+        self.window_lock = Lock()
+        self.window = WindowStats()
+        self.spare_window = WindowStats()
+        self.stopping = Event()
+        self.thread = Thread(target=self._run, name="sensors", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def latest(self):
+        """
+        The current SensorSnapshot. Safe from any thread, it is replaced, never modified.
+        """
+        return self.snapshot
+
+    def _read_cpu(self):
+        self.cpu_temperatures = (self.cpu_temperatures + [get_cpu_temperature()])[-CPU_SMOOTHING:]
+        return {"cpu_temperature": sum(self.cpu_temperatures) / len(self.cpu_temperatures)}
+
+    def _read_bme280(self):
+        raw_temperature = self.bme280.get_temperature()
+        fields = {
+            "raw_temperature": raw_temperature,
+            "pressure": self.bme280.get_pressure(),
+            "humidity": self.bme280.get_humidity(),
+        }
+        cpu_temperature = self.snapshot.cpu_temperature
+        if cpu_temperature is not None:
+            fields["temperature"] = raw_temperature - ((cpu_temperature - raw_temperature) / TEMPERATURE_FACTOR)
+        return fields
+
+    def _read_ltr559(self):
+        return {"light": self.ltr559.get_lux(), "proximity": self.ltr559.get_proximity()}
+
+    def _read_gas(self):
+        gas_data = self.gas.read_all()
+        return {
+            "oxidised": gas_data.oxidising / 1000,
+            "reduced": gas_data.reducing / 1000,
+            "nh3": gas_data.nh3 / 1000,
+        }
+
+    def read(self, group):
+        """
+        Read one group now and publish the new snapshot.
+        """
+        interval, read = self.groups[group]
+        start = time.perf_counter()
+        try:
+            fields = read()
+        except Exception as e:
+            SENSOR_ERRORS.labels(group).inc()
+            logging.error("Failed to read %s, error: %s", group, e)
+            return
+        SENSOR_READ_SECONDS.labels(group).observe(time.perf_counter() - start)
+        self.snapshot = self.snapshot._replace(updated=time.time(), **fields)
+        with self.window_lock:
+            for field, value in fields.items():
+                self.window.add(field, value)
+
+    def collect(self):
+        """
+        Aggregates of the readings since the last call (see WindowStats.result)
+        and start a new window.
+        """
+        with self.window_lock:
+            window, self.window = self.window, self.spare_window
+        stats = window.result()
+        window.reset()
+        self.spare_window = window
+        return stats
+
+    def _run(self):
+        logging.info("Starting sensor service.")
+        now = time.monotonic()
+        due = {group: now for group in self.groups}
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for group, (interval, read) in self.groups.items():
+                if due[group] <= now:
+                    self.read(group)
+                    # stay on the schedule, skip reads that are already late
+                    due[group] += (now - due[group]) // interval * interval + interval
+            self.stopping.wait(max(0, min(due.values()) - time.monotonic()))
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
@@ -1,22 +1,153 @@
 from gpiozero import AngularServo
 from time import sleep
+from threading import Thread, Event
+import time
+import queue
 import logging
 
-# Initialize the servo on GPIO pin 13
-servo = AngularServo(13, min_angle=-90, max_angle=90, min_pulse_width=0.0006, max_pulse_width=0.0023)
+from common import metrics
 
-def extend():
+SERVO_PIN = 13
+MOVE_TIME = 1  # seconds for the servo to reach position before it is detached
+EXTEND_TIME = 5  # seconds the tube stays extended per sample
+TUBE_COOLDOWN = 20  # seconds between samples
+
+EXTENDED = "extended"
+RETRACTED = "retracted"
+EXTENDING = "extending"
+RETRACTING = "retracting"
+
+TUBE_SAMPLES = metrics.counter("sampling_tube_samples_total", "Sampling tube extend/retract cycles")
+TUBE_SKIPPED = metrics.counter("sampling_tube_requests_skipped_total", "Sample requests ignored while busy or cooling down")
+
+servo = None
+
+
+def make_servo(pin=SERVO_PIN, pin_factory=None):
+    # pin_factory can be gpiozero.pins.mock.MockFactory(pin_class=MockPWMPin) off the Pi
+    return AngularServo(pin, min_angle=-90, max_angle=90, min_pulse_width=0.0006, max_pulse_width=0.0023, pin_factory=pin_factory)
+
+
+def _default_servo():
     global servo
+    if servo is None:
+        # Initialize the servo on GPIO pin 13
+        servo = make_servo()
+    return servo
+
+
+def extend():
     logging.info("Extending sampling tube")
-    servo.angle = 90
-    sleep(1)  # Adjust the sleep time as needed
-    servo.detach()  # Detach the servo to stop it from holding the position
+    tube_servo = _default_servo()
+    tube_servo.angle = 90
+    sleep(MOVE_TIME)
+    tube_servo.detach()  # Detach the servo to stop it from holding the position
     logging.info("Sampling tube extended")
 
+
 def retract():
-    global servo
     logging.info("Retracting sampling tube")
-    servo.angle = -90
-    sleep(1)  # Adjust the sleep time as needed
-    servo.detach()  # Detach the servo to stop it from holding the position
-    logging.info("Sampling tube retracted")
\ No newline at end of file
+    tube_servo = _default_servo()
+    tube_servo.angle = -90
+    sleep(MOVE_TIME)
+    tube_servo.detach()  # Detach the servo to stop it from holding the position
+    logging.info("Sampling tube retracted")
+
+
+class TubeScheduler:
+    """
+    Runs the sampling tube from its own thread so callers never wait on the servo.
+
+    Commands go into a queue and are carried out in order by the scheduler
+    thread, which does all the servo timing. request_sample() extends the
+    tube, holds it for extend_time and retracts it, and is ignored while the
+    tube is busy or within cooldown seconds of the last sample. `state` and
+    ready() are plain attribute reads, only the scheduler thread writes them.
+    """
+
+    SAMPLE = "sample"
+    EXTEND = "extend"
+    RETRACT = "retract"
+    STOP = "stop"
+
+    def __init__(self, tube_servo=None, extend_time=EXTEND_TIME, cooldown=TUBE_COOLDOWN, move_time=MOVE_TIME):
+        self.servo = tube_servo if tube_servo is not None else _default_servo()
+        self.extend_time = extend_time
+        self.cooldown = cooldown
+        self.move_time = move_time
+        self.commands = queue.Queue()
+        self.stopping = Event()
+        self.state = RETRACTED
+        self.last_sample = None  # time.monotonic() of the last sample
+        self.thread = Thread(target=self._run, name="sampling-tube", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def cooling_down(self):
+        last_sample = self.last_sample
+        return last_sample is not None and time.monotonic() - last_sample < self.cooldown
+
+    def ready(self):
+        """
+        True if a sample request would be carried out now.
+        """
+        return self.state == RETRACTED and not self.cooling_down()
+
+    def request_sample(self):
+        self.commands.put_nowait(self.SAMPLE)
+
+    def extend(self):
+        self.commands.put_nowait(self.EXTEND)
+
+    def retract(self):
+        self.commands.put_nowait(self.RETRACT)
+
+    def _move(self, angle, moving, done):
+        self.state = moving
+        self.servo.angle = angle
+        sleep(self.move_time)
+        self.servo.detach()  # Detach the servo to stop it from holding the position
+        self.state = done
+        logging.info("Sampling tube %s", done)
+
+    def _sample(self):
+        if not self.ready():
+            TUBE_SKIPPED.inc()
+            logging.info("Tube is busy or cooling down, skipping")
+            return
+        self.last_sample = time.monotonic()
+        TUBE_SAMPLES.inc()
+        self._move(90, EXTENDING, EXTENDED)
+        self.stopping.wait(self.extend_time)
+        self._move(-90, RETRACTING, RETRACTED)
+
+    def _run(self):
+        while True:
+            command = self.commands.get()
+            if command == self.STOP:
+                return
+            if self.stopping.is_set():
+                # drop what was queued before stop()
+                continue
+            try:
+                if command == self.SAMPLE:
+                    self._sample()
+                elif command == self.EXTEND:
+                    self._move(90, EXTENDING, EXTENDED)
+                elif command == self.RETRACT:
+                    self._move(-90, RETRACTING, RETRACTED)
+            except Exception as e:
+                logging.error("Sampling tube command %s failed: %s", command, e)
+
+    def stop(self, timeout=5):
+        """
+        Stop after the current command, leaving the tube retracted.
+        """
+        self.stopping.set()
+        self.commands.put(self.STOP)
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        if self.state == EXTENDED:
+            self._move(-90, RETRACTING, RETRACTED)
@@ -0,0 +1,40 @@
+from collections import deque
+import logging
+
+from common import events, metrics
+
+PRESSURE_THRESHOLD = 2  # gauge readings below this fire the sampling tube
+DEBOUNCE_READINGS = 3  # consecutive low readings needed
+
+TRIGGERS = metrics.counter("sampling_tube_triggers_total", "Sample requests fired by low gauge readings")
+
+
+class PressureTrigger:
+    """
+    Fires the sampling tube from gauge readings as the camera produces them.
+
+    Subscribed to GAUGE_READING on the event bus, so it runs on the camera
+    thread within the frame that completes the condition. The tube is only
+    requested after `readings` consecutive readings below the threshold, a
+    missed or spurious gauge read resets the count.
+    """
+
+    def __init__(self, tube, threshold=PRESSURE_THRESHOLD, readings=DEBOUNCE_READINGS):
+        self.tube = tube
+        self.threshold = threshold
+        self.recent = deque(maxlen=max(readings, 1))
+
+    def attach(self, bus=events.BUS):
+        bus.subscribe(events.GAUGE_READING, self.on_reading)
+        return self
+
+    def on_reading(self, reading):
+        self.recent.append(reading.pressure is not None and reading.pressure < self.threshold)
+        if len(self.recent) < self.recent.maxlen or not all(self.recent):
+            return
+        if not self.tube.ready():
+            return
+        logging.info("Gauge pressure %.2f below %s for %d readings, sampling", reading.pressure, self.threshold, len(self.recent))
+        self.recent.clear()
+        TRIGGERS.inc()
+        self.tube.request_sample()
@@ -0,0 +1,189 @@
+"""
+Benchmark the host side stages of the detection pipeline without a camera.
+
+Runs each stage over a fixed corpus of frames and detections, either a
+synthetic corpus or a session recorded with SessionRecorder, and reports
+throughput and p50/p99 latency per stage as JSON.
+
+    python -m target_acquisition.benchmark --frames 200 --output bench.json
+    python -m target_acquisition.benchmark --replay /path/to/session
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import cv2
+import numpy as np
+
+from .camera_detection import CameraDetection, CONFIG_PATH
+from .frame import Frame
+from .sources import ReplaySource, ReplayMessage, ReplayDetection, SessionRecorder
+
+FRAME_SIZE = 640
+FRAME_RATE = 10
+SEED = 455
+
+# a 640x640 preview of the RGB camera, roughly what the OAK-D reports
+SYNTHETIC_INTRINSICS = {
+    "calibrationMatrix": [[500.0, 0.0, 320.0], [0.0, 500.0, 320.0], [0.0, 0.0, 1.0]],
+    "distortionCoefficients": [0.0] * 14,
+}
+
+STAGES = ("annotate", "detect_aruco", "select_best", "calculate_pressure", "pil_conversion", "total")
+
+
+def _box(label, cx, cy, size, confidence=0.9):
+    half = size / 2 / FRAME_SIZE
+    cx, cy = cx / FRAME_SIZE, cy / FRAME_SIZE
+    return ReplayDetection(label, confidence, cx - half, cy - half, cx + half, cy + half)
+
+
+def write_synthetic_session(path, frames, labels):
+    """
+    Write a synthetic session: a moving ArUco marker next to a pressure gauge and a valve,
+    with detections for every part in the model's label set.
+    """
+    rng = np.random.default_rng(SEED)
+    label_ids = {label: i for i, label in enumerate(labels)}
+    aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_250)
+    marker = cv2.aruco.generateImageMarker(aruco_dict, 7, 120)
+    marker = cv2.copyMakeBorder(marker, 20, 20, 20, 20, cv2.BORDER_CONSTANT, value=255)
+    # smooth noise, white noise makes the marker search unrealistically expensive
+    background = rng.integers(0, 255, (FRAME_SIZE, FRAME_SIZE, 3), dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (0, 0), 6)
+
+    recorder = SessionRecorder(path, SYNTHETIC_INTRINSICS, labels, block=True)
+    for i in range(frames):
+        frame = background.copy()
+        # marker drifts across the left half of the frame
+        mx = 40 + int(200 * (0.5 + 0.5 * np.sin(i / 15)))
+        my = 40 + int(100 * (0.5 + 0.5 * np.cos(i / 20)))
+        frame[my:my + marker.shape[0], mx:mx + marker.shape[1]] = marker[:, :, None]
+        cx, cy = mx + marker.shape[1] / 2, my + marker.shape[0] / 2
+
+        # gauge on the right, needle sweeping
+        angle = np.pi * (0.75 + 1.5 * (i % 50) / 50)
+        gx, gy = 480, 400
+        detections = [
+            _box(label_ids["aruco"], cx, cy, marker.shape[0]),
+            _box(label_ids["gauge_bbox"], gx, gy, 200),
+            _box(label_ids["gauge_base"], gx, gy, 16),
+            _box(label_ids["gauge_min"], gx - 60, gy + 60, 16),
+            _box(label_ids["gauge_max"], gx + 60, gy + 60, 16),
+            _box(label_ids["gauge_tip"], gx + 70 * np.cos(angle), gy - 70 * np.sin(angle), 16),
+            _box(label_ids["valve_open" if i % 2 else "valve_closed"], 120, 520, 80, 0.7),
+        ]
+        timestamp = i / FRAME_RATE
+        rgb_msg = ReplayMessage(i, timestamp, frame=frame)
+        nn_msg = ReplayMessage(i, timestamp, detections=detections)
+        recorder.write(frame, rgb_msg, nn_msg)
+    recorder.close()
+
+
+def load_corpus(source):
+    """
+    Read every (frame, detections, timestamp) from a non-realtime replay source.
+    """
+    corpus = []
+    rgb_queue, nn_queue = source.get_queue("rgb"), source.get_queue("nn")
+    while True:
+        rgb, nn = rgb_queue.tryGet(), nn_queue.tryGet()
+        if rgb is None or nn is None:
+            break
+        corpus.append((rgb.frame, nn.detections, rgb.getTimestamp().total_seconds()))
+    return corpus
+
+
+def _timed(timings, stage, fn, *args):
+    start = time.perf_counter_ns()
+    result = fn(*args)
+    timings[stage].append(time.perf_counter_ns() - start)
+    return result
+
+
+def run(camera, total_camera, corpus, warmup=10):
+    """
+    Time every stage over the corpus. Returns stage -> list of nanosecond durations.
+
+    The stages and "total" run on separate CameraDetection instances, as the
+    ArUco search keeps state between frames (which frames get a full frame
+    search, the pose tracks): sharing one would give each of them every other
+    frame and a tracker the other had already updated.
+    """
+    timings = {stage: [] for stage in STAGES}
+    for i, (frame, detections, timestamp) in enumerate(corpus[:warmup] + corpus):
+        sample = timings if i >= warmup else {stage: [] for stage in STAGES}
+
+        rgb = frame.copy()
+        _timed(sample, "detect_aruco", camera._detect_aruco, rgb, detections, timestamp)
+        annotated = _timed(sample, "annotate", camera._annotate_frame, rgb, detections)
+        best = _timed(sample, "select_best", camera._select_gauge_detections, detections)
+        if best is not None:
+            _timed(sample, "calculate_pressure", camera._gauge_pressure, best, rgb.shape)
+        _timed(sample, "pil_conversion", lambda array: Frame(array).image(), annotated)
+
+        rgb = frame.copy()
+        _timed(sample, "total", total_camera._process, rgb, detections, timestamp)
+    return timings
+
+
+def summarise(timings):
+    results = {}
+    for stage, durations in timings.items():
+        if not durations:
+            continue
+        ns = np.array(durations, dtype=np.float64)
+        results[stage] = {
+            "count": len(durations),
+            "throughput_per_s": len(durations) / (ns.sum() / 1e9),
+            "mean_ms": ns.mean() / 1e6,
+            "p50_ms": np.percentile(ns, 50) / 1e6,
+            "p99_ms": np.percentile(ns, 99) / 1e6,
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", help="recorded session to benchmark instead of the synthetic corpus")
+    parser.add_argument("--frames", type=int, default=200, help="number of synthetic frames")
+    parser.add_argument("--warmup", type=int, default=10, help="frames run before timing starts")
+    parser.add_argument("--output", help="write the results to this JSON file instead of stdout")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.replay
+        if path is None:
+            with open(CONFIG_PATH, "r") as f:
+                labels = json.load(f)["mappings"]["labels"]
+            path = os.path.join(tmp, "session")
+            write_synthetic_session(path, args.frames, labels)
+        camera = CameraDetection(source=ReplaySource(path, realtime=False))
+        total_camera = CameraDetection(source=ReplaySource(path, realtime=False))
+        corpus = load_corpus(ReplaySource(path, realtime=False))
+
+        timings = run(camera, total_camera, corpus, args.warmup)
+
+    report = {
+        "corpus": args.replay or "synthetic",
+        "frames": len(corpus),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "stages": summarise(timings),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,57 +1,100 @@
 
-import depthai as dai
-from PIL import Image
+import os
 from .detection_tools import calculate_pressure
+from .frame import Frame
+from .frame_sync import FrameSynchronizer
+from .pose_tracker import MarkerPoseTracker
+from .sources import DeviceSource, SessionRecorder, dai
 import cv2
 import numpy as np
 import json
-from time import sleep
+import time
 import logging
+from common import metrics, events
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model")
+NN_PATH = os.path.join(MODEL_DIR, "best_openvino_2022.1_6shave.blob")
+CONFIG_PATH = os.path.join(MODEL_DIR, "best.json")
+
+# ArUco search mode: "roi" searches only around the model's aruco boxes, "full" searches the whole frame
+ARUCO_MODE = "roi"
+ARUCO_ROI_PADDING = 0.5  # fraction of the box size added to each side of the crop
+ARUCO_MIN_ROI_SIZE = 48  # pixels
+ARUCO_FULL_FRAME_INTERVAL = 10  # marker searches between full frame searches in roi mode
+ARUCO_DETECT_INTERVAL = 1  # run marker detection every N frames, poses are predicted in between
+# TODO: Extract the marker length into a configuration file
+MARKER_LENGTH = 0.065  # meters
+
+MESSAGES_IN = metrics.counter("camera_messages_total", "Messages read from the device output queues", ["stream"])
+FRAMES_MATCHED = metrics.counter("camera_frames_matched_total", "Frames paired with their detections")
+MESSAGES_UNMATCHED = metrics.counter("camera_messages_unmatched_total", "Messages aged out without a match")
+EMPTY_POLLS = metrics.counter("camera_empty_polls_total", "get_frame calls with no matched frame available")
+RESTARTS = metrics.counter("camera_pipeline_restarts_total", "Pipeline restarts")
+STAGE_SECONDS = metrics.histogram("camera_stage_seconds", "Host processing time per stage", ["stage"])
 
 
 class CameraDetection:
-    def __init__(self):
-        self._init_camera_intrinsics()
+    def __init__(self, source=None, nn_path=NN_PATH, config_path=CONFIG_PATH, record_path=None):
+        """
+        source: where frames and detections come from, defaults to an OAK-D running
+            the detection pipeline. Pass a ReplaySource to run without a camera.
+        record_path: if given, matched raw frames and detections are recorded there
+            for later replay.
+        """
+        self.nn_path = nn_path
+        self.config = self._load_config(config_path)
+        if source is None:
+            self.pipeline = self.setup_camera()
+            source = DeviceSource(self.pipeline)
+        self.source = source
+        self.intrinsics = self.source.intrinsics
         self._init_aruco()
-        self.nn_path = "/home/team6/Drone/target_acquisition/model/best_openvino_2022.1_6shave.blob"
-        self.pipeline = self.setup_camera()
-        self.device = dai.Device(self.pipeline)
-        self.device.startPipeline() 
-        self.rgb_queue = self.device.getOutputQueue("rgb", maxSize=8, blocking=False)
-        self.detection_queue = self.device.getOutputQueue("nn", maxSize=8, blocking=False)
+        self.rgb_queue = self.source.get_queue("rgb")
+        self.detection_queue = self.source.get_queue("nn")
+        self.sync = FrameSynchronizer(("rgb", "nn"))
+        self.recorder = None
+        if record_path is not None:
+            self.recorder = SessionRecorder(record_path, self.intrinsics, self.labels)
     
     def _restart_pipeline(self):
         """
-        Safely restarts the DepthAI pipeline and reinitializes the device and output queues.
+        Safely restarts the source and reinitializes the output queues.
         """
         try:
             logging.info("Restarting the pipeline.")
-            # Close the existing device connection
-            self.device.close()
-            # Wait for the device to close
-            sleep(1)
-            # Reinitialize the device with the pipeline
-            self.device = dai.Device(self.pipeline, maxUsbSpeed=dai.UsbSpeed.SUPER_PLUS)
-            self.device.startPipeline()
+            RESTARTS.inc()
+            self.source.restart()
             # Recreate the output queues
-            self.rgb_queue = self.device.getOutputQueue("rgb", maxSize=8, blocking=False)
-            self.detection_queue = self.device.getOutputQueue("nn", maxSize=8, blocking=False)
+            self.rgb_queue = self.source.get_queue("rgb")
+            self.detection_queue = self.source.get_queue("nn")
+            # sequence numbers and timestamps restart with the pipeline
+            self.sync.clear()
+            self.pose_tracker.clear()
         except Exception as e:
             logging.error("Failed to restart the pipeline: %s", e)
 
-    def _init_camera_intrinsics(self):
+    def clock(self):
+        """
+        Current time on the frame timestamp clock, or None if the source has no live clock.
+        """
+        return self.source.clock()
+
+    def close(self):
         """
-        Get the camera intrinsics
+        Finish the recording, if any, and close the source.
         """
-        # Get the camera intrinsics
-        with dai.Device() as device:
-            calibData = device.readCalibration()
-            calibrationMatrix = calibData.getCameraIntrinsics(dai.CameraBoardSocket.RGB)
-            distortion = calibData.getDistortionCoefficients(dai.CameraBoardSocket.RGB)
-            self.intrinsics = {
-                "calibrationMatrix": calibrationMatrix,
-                "distortionCoefficients": distortion
-            }
+        if self.recorder is not None:
+            self.recorder.close()
+        self.source.close()
+
+    def _load_config(self, config_path):
+        """
+        Load the model config and the label mapping
+        """
+        with open(config_path, "r") as f:
+            config = json.load(f)
+        self.labels = config.get("mappings", {}).get("labels", {})
+        return config
 
     def setup_camera(self):
         """
@@ -62,10 +105,7 @@ class CameraDetection:
         """
         pipeline = dai.Pipeline()
 
-        with open("/home/team6/Drone/target_acquisition/model/best.json", "r") as f:
-            config = json.load(f)
-        
-        nnConfig = config.get("nn_config", {})
+        nnConfig = self.config.get("nn_config", {})
 
         metadata = nnConfig.get("NN_specific_metadata", {})
 
@@ -75,7 +115,6 @@ class CameraDetection:
         anchorMasks = metadata.get("anchor_masks", {})
         iouThreshold = metadata.get("iou_threshold", {})
         confidenceThreshold = metadata.get("confidence_threshold", {})
-        self.labels = config.get("mappings", {}).get("labels", {})
 
         # Setup the camera for rgb
         cam_rgb = pipeline.createColorCamera()
@@ -132,10 +171,146 @@ class CameraDetection:
 
 
 
-    def get_frame(self, rgb_only=False):
+    def _valve_state(self, detections):
+        """
+        Get the valve state from the most confident valve detection.
+        Returns True if open, False if closed, None if unknown.
+        """
+        valve_conf = {'open': 0, 'closed': 0}
+
+        for detection in detections:
+            label = self.labels[detection.label]
+            if label == "valve_closed":
+                valve_conf['closed'] = max(valve_conf['closed'], detection.confidence)
+            elif label == "valve_open":
+                valve_conf['open'] = max(valve_conf['open'], detection.confidence)
+
+        if valve_conf['closed'] > valve_conf['open']:
+            return False
+        elif valve_conf['open'] > valve_conf['closed']:
+            return True
+        return None
+
+    def _select_gauge_detections(self, detections):
+        """
+        Pick the most confident detection of each gauge part.
+        Returns a dict of label -> detection, or None if a part is missing.
+        """
+        required_labels = ["gauge_min", "gauge_max", "gauge_tip", "gauge_base"]
+        # Initialize dictionary to store best detections
+        best_detections = {}
+
+        # Extract best detections for each required part (based on confidence)
+        for detection in detections:
+            label = self.labels[detection.label]
+            if label in required_labels:
+                if label not in best_detections or detection.confidence > best_detections[label].confidence:
+                    best_detections[label] = detection
+
+        # Proceed only if all required parts are detected
+        if all(label in best_detections for label in required_labels):
+            return best_detections
+        return None
+
+    def _gauge_pressure(self, best_detections, shape):
+        """
+        Read the pressure from the gauge part detections on a frame of the given shape.
+        """
+        # Get image dimensions
+        height, width = shape[:2]
+
+        # Helper function to calculate center coordinates
+        def get_center_coords(detection):
+            x_center = int(((detection.xmin + detection.xmax) / 2) * width)
+            y_center = int(((detection.ymin + detection.ymax) / 2) * height)
+            return np.array([x_center, y_center])
+
+        # Extract center coordinates
+        gauge_min_coords = get_center_coords(best_detections['gauge_min'])
+        gauge_max_coords = get_center_coords(best_detections['gauge_max'])
+        needle_tip_coords = get_center_coords(best_detections['gauge_tip'])
+        needle_base_coords = get_center_coords(best_detections['gauge_base'])
+
+        # Calculate pressure
+        # TODO: Extract magic numbers into configuration file
+        min_value = 0
+        max_value = 10
+        return calculate_pressure(
+            needle_base_coords, 
+            needle_tip_coords, 
+            gauge_min_coords, 
+            gauge_max_coords, 
+            min_value, 
+            max_value
+        )
+
+    def _process(self, rgb, detections, timestamp=None, rgb_only=False):
+        """
+        Run the host side processing for a frame and its detections.
+        Returns the (annotated) frame array and the details dict.
+        """
+        details = {}
+        labels = [self.labels[detection.label] for detection in detections]
+        details['detections'] = detections
+        details['valve_state'] = self._valve_state(detections)
+
+        # search for markers before the frame is drawn on
+        start = time.perf_counter()
+        aruco = self._detect_aruco(rgb, detections, timestamp)
+        STAGE_SECONDS.labels("aruco").observe(time.perf_counter() - start)
+        annotated = rgb
+        if not rgb_only:
+            start = time.perf_counter()
+            annotated = self._annotate_frame(rgb, detections)
+            STAGE_SECONDS.labels("annotate").observe(time.perf_counter() - start)
+        if len(aruco) > 1:
+            logging.warning("Multiple ArUco markers detected. Using the first one.")
+        for marker in aruco:
+            # there may be multiple, lets just use the first one
+            if not rgb_only:
+                cv2.aruco.drawDetectedMarkers(annotated, [marker['corners']], borderColor=(255, 0, 0))
+            tvec = marker['tvec'].ravel()
+            details['aruco_id'] = int(marker['id'])
+            details['aruco_pose_x'] = float(tvec[0])
+            details['aruco_pose_y'] = float(tvec[1])
+            details['aruco_pose_z'] = float(tvec[2])
+            break
+        if "gauge_bbox" in labels:
+            # Calculate Pressure
+            start = time.perf_counter()
+            best_detections = self._select_gauge_detections(detections)
+            if best_detections is not None:
+                details['pressure'] = self._gauge_pressure(best_detections, rgb.shape)
+            STAGE_SECONDS.labels("gauge").observe(time.perf_counter() - start)
+        return annotated, details
+
+    def _read_matched(self):
+        """
+        Move everything that has arrived into the synchronizer and pop the oldest
+        rgb frame that has its matching detections, or None.
+        """
+        start = time.perf_counter()
+        dropped = self.sync.dropped
+        rgb_msgs = self.rgb_queue.tryGetAll()
+        nn_msgs = self.detection_queue.tryGetAll()
+        for msg in rgb_msgs:
+            self.sync.add("rgb", msg)
+        for msg in nn_msgs:
+            self.sync.add("nn", msg)
+        matched = self.sync.get()
+        MESSAGES_IN.labels("rgb").inc(len(rgb_msgs))
+        MESSAGES_IN.labels("nn").inc(len(nn_msgs))
+        MESSAGES_UNMATCHED.inc(self.sync.dropped - dropped)
+        STAGE_SECONDS.labels("sync").observe(time.perf_counter() - start)
+        return matched
+
+    def get_frame(self, rgb_only=False, timeout=None):
         """
         Read a frame from the camera, do object detection and processing, then return the frame and the detections
 
+        If timeout is given, block for up to that many seconds until a matched frame
+        arrives instead of returning straight away.
+
         details:
         {
             valve_state: "open":True | "closed":False,
@@ -146,103 +321,40 @@ class CameraDetection:
                 z: float
             },
             pressure: float,
+            timestamp: float,
         }
         """
         # for now just return empty details and the raw rgb image
         details = {}
         try:
-            # get the detections
-            detections_nndata = self.detection_queue.tryGet()
-            # get the rgb image from the camera
-            rgb = self.rgb_queue.tryGet()
-            if rgb is None or detections_nndata is None:
+            matched = self._read_matched()
+            if matched is None and timeout is not None:
+                deadline = time.monotonic() + timeout
+                while matched is None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    # wake up as soon as the device delivers anything
+                    self.source.wait(remaining)
+                    matched = self._read_matched()
+            if matched is None:
+                EMPTY_POLLS.inc()
                 return None, details
-            rgb = rgb.getCvFrame()
+            start = time.perf_counter()
+            FRAMES_MATCHED.inc()
+            detections_nndata = matched["nn"]
+            rgb = matched["rgb"].getCvFrame()
+            if self.recorder is not None:
+                self.recorder.write(rgb, matched["rgb"], detections_nndata)
+            timestamp = matched["rgb"].getTimestamp().total_seconds()
             detections = detections_nndata.detections
-            annotated = rgb
-            if not rgb_only:
-                annotated = self._annotate_frame(rgb, detections)
-            labels = [self.labels[detection.label] for detection in detections]
-            details['detections'] = detections
-            valve_conf = {'open': 0, 'closed': 0}
-
-            for detection in detections:
-                label = self.labels[detection.label]
-                if label == "valve_closed":
-                    valve_conf['closed'] = max(valve_conf['closed'], detection.confidence)
-                elif label == "valve_open":
-                    valve_conf['open'] = max(valve_conf['open'], detection.confidence)
-
-            if valve_conf['closed'] > valve_conf['open']:
-                details['valve_state'] = False
-            elif valve_conf['open'] > valve_conf['closed']:
-                details['valve_state'] = True
-            else:
-                details['valve_state'] = None
-                
-
-            if True: #"aruco" in labels:
-                aruco = self._detect_aruco(rgb)
-                if len(aruco) > 1:
-                    logging.warning("Multiple ArUco markers detected. Using the first one.")
-                for marker in aruco:
-                    # there may be multiple, lets just use the first one
-                    if not rgb_only:
-                        cv2.aruco.drawDetectedMarkers(annotated, [marker['corners']], borderColor=(255, 0, 0))
-                    details['aruco_id'] = int(marker['id'])
-                    details['aruco_pose_x'] = float(marker['tvec'][0])
-                    details['aruco_pose_y'] = float(marker['tvec'][1])
-                    details['aruco_pose_z'] = float(marker['tvec'][2])
-                    break
-            if "gauge_bbox" in labels:
-                # Calculate Pressure
-                required_labels = ["gauge_min", "gauge_max", "gauge_tip", "gauge_base"]
-                if all(label in labels for label in required_labels):
-                    # Initialize dictionary to store best detections
-                    best_detections = {}
-
-                    # Extract best detections for each required part (based on confidence)
-                    for detection in detections:
-                        label = self.labels[detection.label]
-                        if label in required_labels:
-                            if label not in best_detections or detection.confidence > best_detections[label].confidence:
-                                best_detections[label] = detection
-
-                    # Proceed only if all required parts are detected
-                    if all(label in best_detections for label in required_labels):
-                        # Get image dimensions
-                        height, width, _ = rgb.shape
-
-                        # Helper function to calculate center coordinates
-                        def get_center_coords(detection):
-                            x_center = int(((detection.xmin + detection.xmax) / 2) * width)
-                            y_center = int(((detection.ymin + detection.ymax) / 2) * height)
-                            return np.array([x_center, y_center])
-
-                        # Extract center coordinates
-                        gauge_min_coords = get_center_coords(best_detections['gauge_min'])
-                        gauge_max_coords = get_center_coords(best_detections['gauge_max'])
-                        needle_tip_coords = get_center_coords(best_detections['gauge_tip'])
-                        needle_base_coords = get_center_coords(best_detections['gauge_base'])
-
-                        # Calculate pressure
-                        # TODO: Extract magic numbers into configuration file
-                        min_value = 0
-                        max_value = 10
-                        pressure = calculate_pressure(
-                            needle_base_coords, 
-                            needle_tip_coords, 
-                            gauge_min_coords, 
-                            gauge_max_coords, 
-                            min_value, 
-                            max_value
-                        )
-                        details['pressure'] = pressure
-                    else:
-                        logging.warning("Not all required parts detected for pressure gauge.")
-            # convert the image to a PIL image
-            annotated = Image.fromarray(annotated)
-            return annotated, details
+            annotated, details = self._process(rgb, detections, timestamp, rgb_only)
+            details['timestamp'] = timestamp
+            # straight to subscribers (e.g. the sampling tube trigger), not on the next poll
+            events.publish(events.GAUGE_READING, events.GaugeReading(details.get('pressure'), timestamp))
+            STAGE_SECONDS.labels("frame").observe(time.perf_counter() - start)
+            # wrap the image, consumers derive the forms they need from it
+            return Frame(annotated), details
         except RuntimeError as e:
             logging.error(f"An error occurred: {e}")
             if 'X_LINK_ERROR' in str(e):
@@ -259,7 +371,7 @@ class CameraDetection:
 
     def _init_aruco(self):
         """
-        Initialize the ArUco detector.
+        Initialize the ArUco detector and the constant arrays used for pose estimation.
         """
         # Load the predefined dictionary
         self.aruco_dict = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_5X5_250)
@@ -268,56 +380,124 @@ class CameraDetection:
         self.parameters = cv2.aruco.DetectorParameters()
 
         self.aruco_detector = cv2.aruco.ArucoDetector(self.aruco_dict, self.parameters)
-    
-    def _detect_aruco(self, frame):
+
+        self.camera_matrix = np.array(self.intrinsics["calibrationMatrix"])
+        self.dist_coeffs = np.array(self.intrinsics["distortionCoefficients"])
+
+        # Define the 3D coordinates of the marker's corners in the marker's own reference frame
+        self.marker_corners_3d = np.array([
+            [-MARKER_LENGTH / 2, MARKER_LENGTH / 2, 0],
+            [MARKER_LENGTH / 2, MARKER_LENGTH / 2, 0],
+            [MARKER_LENGTH / 2, -MARKER_LENGTH / 2, 0],
+            [-MARKER_LENGTH / 2, -MARKER_LENGTH / 2, 0]
+        ], dtype=np.float32)
+
+        self.aruco_mode = ARUCO_MODE
+        self.aruco_frame_count = 0  # frames seen, for ARUCO_DETECT_INTERVAL
+        self.aruco_search_count = 0  # marker searches run, for ARUCO_FULL_FRAME_INTERVAL
+        self.pose_tracker = MarkerPoseTracker(self.marker_corners_3d, self.camera_matrix, self.dist_coeffs)
+
+    def _aruco_rois(self, frame, detections):
+        """
+        Get padded (x0, y0, x1, y1) pixel regions around the aruco detections.
+        """
+        height, width = frame.shape[:2]
+        rois = []
+        for detection in detections:
+            if self.labels[detection.label] != "aruco":
+                continue
+            x0, y0, x1, y1 = self._frame_norm(frame, (detection.xmin, detection.ymin, detection.xmax, detection.ymax))
+            pad_x = max(int((x1 - x0) * ARUCO_ROI_PADDING), (ARUCO_MIN_ROI_SIZE - (x1 - x0)) // 2, 0)
+            pad_y = max(int((y1 - y0) * ARUCO_ROI_PADDING), (ARUCO_MIN_ROI_SIZE - (y1 - y0)) // 2, 0)
+            rois.append((max(x0 - pad_x, 0), max(y0 - pad_y, 0), min(x1 + pad_x, width), min(y1 + pad_y, height)))
+        return rois
+
+    def _find_markers(self, frame, detections):
+        """
+        Find marker corners in full frame coordinates.
+
+        In roi mode only the regions around the model's aruco boxes are searched,
+        with a full frame search every ARUCO_FULL_FRAME_INTERVAL searches to catch
+        markers the model missed.
+
+        Returns a list of (id, corners) with corners shaped (1, 4, 2).
+        """
+        self.aruco_search_count += 1
+        full_frame = (
+            self.aruco_mode != "roi"
+            or detections is None
+            or self.aruco_search_count % ARUCO_FULL_FRAME_INTERVAL == 0
+        )
+        if full_frame:
+            rois = [(0, 0, frame.shape[1], frame.shape[0])]
+        else:
+            rois = self._aruco_rois(frame, detections)
+
+        markers = {}
+        for x0, y0, x1, y1 in rois:
+            if x1 <= x0 or y1 <= y0:
+                continue
+            # Convert the region to grayscale
+            gray = cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+            # Detect the markers in the grayscale image
+            corners, ids, _ = self.aruco_detector.detectMarkers(gray)
+            if ids is None:
+                continue
+            offset = np.array([x0, y0], dtype=np.float32)
+            for marker_corners, marker_id in zip(corners, ids.ravel()):
+                # overlapping regions can see the same marker twice
+                if marker_id not in markers:
+                    markers[marker_id] = marker_corners + offset
+        return list(markers.items())
+
+    def _detect_aruco(self, frame, detections=None, timestamp=None):
         """
         Detect ArUco markers in the given frame and estimate their poses.
 
+        Poses are filtered per marker id by the pose tracker. On frames where detection
+        is skipped, or no marker is found, the tracked poses are predicted instead.
+
         Parameters:
         frame (numpy.ndarray): The current camera frame.
+        detections (list): The model's detections for the frame, used to limit the search
+            to the aruco boxes. If None the whole frame is searched.
+        timestamp (float): Capture time of the frame in seconds. If None the poses are
+            solved from scratch and not tracked.
 
         Returns:
         list: A list of detections and their pose estimations.
         """
-        # Convert the frame to grayscale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        
-        # Detect the markers in the grayscale image
-        corners, ids, rejectedImgPoints = self.aruco_detector.detectMarkers(gray)
-        
-        detections = []
+        frame_number = self.aruco_frame_count
+        self.aruco_frame_count += 1
+        if timestamp is not None and frame_number % ARUCO_DETECT_INTERVAL != 0:
+            return self.pose_tracker.predict(timestamp)
 
-        camera_matrix = np.array(self.intrinsics["calibrationMatrix"])
-        dist_coeffs = np.array(self.intrinsics["distortionCoefficients"])
-        
-        # Define the 3D coordinates of the marker's corners in the marker's own reference frame
-        # Assuming a square marker with side length 0.05 meters
-        # TODO: Extract the marker length into a configuration file
-        marker_length = 0.065
-        marker_corners_3d = np.array([
-            [-marker_length / 2, marker_length / 2, 0],
-            [marker_length / 2, marker_length / 2, 0],
-            [marker_length / 2, -marker_length / 2, 0],
-            [-marker_length / 2, -marker_length / 2, 0]
-        ], dtype=np.float32)
+        detections_out = []
 
         # If markers are detected, estimate their poses
-        if ids is not None:
-            for i in range(len(ids)):
-                # Extract the corners for the current marker
-                corners_2d = corners[i][0]
-                
-                # Use solvePnP to estimate the pose (rvec, tvec)
-                success, rvec, tvec = cv2.solvePnP(marker_corners_3d, corners_2d, camera_matrix, dist_coeffs)
-                
-                if success:
-                    detection = {
-                        'id': ids[i][0],
-                        'corners': corners[i],
-                        'rvec': rvec,
-                        'tvec': tvec
-                    }
-                    detections.append(detection)
-        
-        return detections
+        for marker_id, corners in self._find_markers(frame, detections):
+            # Extract the corners for the current marker
+            corners_2d = corners[0]
 
+            if timestamp is None:
+                # Use solvePnP to estimate the pose (rvec, tvec)
+                success, rvec, tvec = cv2.solvePnP(self.marker_corners_3d, corners_2d, self.camera_matrix, self.dist_coeffs)
+                pose = (rvec, tvec) if success else None
+            else:
+                pose = self.pose_tracker.solve(marker_id, corners_2d, timestamp)
+
+            if pose is not None:
+                rvec, tvec = pose
+                detection = {
+                    'id': marker_id,
+                    'corners': corners,
+                    'rvec': rvec,
+                    'tvec': tvec
+                }
+                detections_out.append(detection)
+
+        if not detections_out and timestamp is not None:
+            # marker briefly lost, coast on the tracked poses
+            return self.pose_tracker.predict(timestamp)
+
+        return detections_out
@@ -1,4 +1,8 @@
-from ultralytics.engine.results import Results, Boxes
+try:
+    from ultralytics.engine.results import Results, Boxes
+except ImportError:
+    # only used for type hints, the camera pipeline does not need ultralytics
+    Results = Boxes = None
 import numpy as np
 from PIL import Image
 import logging
@@ -0,0 +1,60 @@
+from io import BytesIO
+from threading import Lock
+from PIL import Image
+
+JPEG_QUALITY = 75  # PIL default
+
+
+class Frame:
+    """
+    An immutable camera frame holding the raw numpy array.
+
+    Derived forms (PIL image, JPEG bytes, resized images) are computed lazily the
+    first time a consumer asks for them and cached, so a frame shared between the
+    web server and the LCD is converted at most once per form.
+    """
+
+    __slots__ = ("array", "_lock", "_image", "_jpeg", "_resized")
+
+    def __init__(self, array):
+        array.setflags(write=False)
+        self.array = array
+        self._lock = Lock()
+        self._image = None
+        self._jpeg = {}
+        self._resized = {}
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def image(self):
+        """
+        The frame as a PIL image.
+        """
+        with self._lock:
+            if self._image is None:
+                self._image = Image.fromarray(self.array)
+            return self._image
+
+    def jpeg(self, quality=JPEG_QUALITY):
+        """
+        The frame encoded as JPEG bytes at the given quality.
+        """
+        image = self.image()
+        with self._lock:
+            if quality not in self._jpeg:
+                buffer = BytesIO()
+                image.save(buffer, format="JPEG", quality=quality)
+                self._jpeg[quality] = buffer.getvalue()
+            return self._jpeg[quality]
+
+    def resized(self, size):
+        """
+        The frame as a PIL image resized to (width, height), e.g. for the LCD.
+        """
+        image = self.image()
+        with self._lock:
+            if size not in self._resized:
+                self._resized[size] = image.resize(size)
+            return self._resized[size]
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import logging
+
+BUFFER_SIZE = 8
+TIMESTAMP_TOLERANCE = 0.02  # seconds, used when matching by timestamp
+
+
+class FrameSynchronizer:
+    """
+    Pairs messages from the rgb (passthrough) and nn (detections) streams.
+
+    Each stream keeps a small bounded buffer keyed by the DepthAI sequence number
+    (or device timestamp). A frame is only released once the matching message from
+    the other stream has arrived, so every inferred frame is used exactly once and
+    is never paired with detections from a different frame. Messages older than the
+    newest matched pair can never be matched any more and are aged out.
+    """
+
+    def __init__(self, streams=("rgb", "nn"), buffer_size=BUFFER_SIZE, match_by="sequence",
+                 tolerance=TIMESTAMP_TOLERANCE):
+        if match_by not in ("sequence", "timestamp"):
+            raise ValueError(f"Unknown match_by: {match_by}")
+        self.streams = tuple(streams)
+        self.buffer_size = buffer_size
+        self.match_by = match_by
+        self.tolerance = tolerance
+        self.buffers = {name: OrderedDict() for name in self.streams}
+        self.matched = 0
+        self.dropped = 0
+
+    def _key(self, msg):
+        if self.match_by == "sequence":
+            return msg.getSequenceNum()
+        return msg.getTimestamp().total_seconds()
+
+    def add(self, stream, msg):
+        """
+        Add a message from the given stream to its buffer.
+        """
+        buffer = self.buffers[stream]
+        buffer[self._key(msg)] = msg
+        while len(buffer) > self.buffer_size:
+            buffer.popitem(last=False)
+            self.dropped += 1
+
+    def _find(self, stream, key):
+        buffer = self.buffers[stream]
+        if self.match_by == "sequence":
+            return key if key in buffer else None
+        for other in buffer:
+            if abs(other - key) <= self.tolerance:
+                return other
+        return None
+
+    def _age_out(self, key):
+        """
+        Drop every buffered message older than the given key, they cannot be matched any more.
+        """
+        for buffer in self.buffers.values():
+            stale = [other for other in buffer if other < key]
+            for other in stale:
+                del buffer[other]
+            self.dropped += len(stale)
+
+    def get(self):
+        """
+        Pop the oldest complete set of messages.
+
+        Returns a dict of stream name -> message, or None if nothing is matched yet.
+        """
+        first, *others = self.streams
+        for key in self.buffers[first]:
+            keys = [self._find(stream, key) for stream in others]
+            if any(other is None for other in keys):
+                continue
+            messages = {first: self.buffers[first].pop(key)}
+            for stream, other in zip(others, keys):
+                messages[stream] = self.buffers[stream].pop(other)
+            self._age_out(key)
+            self.matched += 1
+            return messages
+        return None
+
+    def pending(self):
+        """
+        Number of buffered messages per stream.
+        """
+        return {name: len(buffer) for name, buffer in self.buffers.items()}
+
+    def clear(self):
+        if any(self.buffers.values()):
+            logging.info("Clearing frame synchronizer buffers: %s", self.pending())
+        for buffer in self.buffers.values():
+            buffer.clear()
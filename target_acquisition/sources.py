@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import queue
+import bisect
+import logging
+from datetime import timedelta
+from threading import Event, Thread
+
+import cv2
+import numpy as np
+
+from common import metrics
+
+try:
+    import depthai as dai
+except ImportError:
+    # replay sources work without the DepthAI SDK
+    dai = None
+
+QUEUE_SIZE = 8
+STREAMS = ("rgb", "nn")
+RECORD_FORMAT = ".png"
+RECORD_QUEUE_SIZE = 32  # frames waiting to be written before new ones are dropped
+# fastest PNG compression, still lossless; the Pi's CPU is shared with the pipeline
+RECORD_ENCODE_PARAMS = {".png": [cv2.IMWRITE_PNG_COMPRESSION, 1]}
+
+RECORD_DROPPED = metrics.counter("camera_record_dropped_total", "Frames not recorded because the recorder fell behind or failed")
+
+
+class DeviceSource:
+    """
+    Frames and detections from an OAK-D running the given pipeline.
+    """
+
+    def __init__(self, pipeline, queue_size=QUEUE_SIZE):
+        if dai is None:
+            raise RuntimeError("depthai is not installed, use a ReplaySource instead")
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        # set by the queue callbacks whenever a message arrives
+        self.data_event = Event()
+        self.device = dai.Device(self.pipeline)
+        self.device.startPipeline()
+        self.intrinsics = self._read_intrinsics()
+        self._open_queues()
+
+    def _read_intrinsics(self):
+        """
+        Get the camera intrinsics from the open device
+        """
+        calibData = self.device.readCalibration()
+        return {
+            "calibrationMatrix": calibData.getCameraIntrinsics(dai.CameraBoardSocket.RGB),
+            "distortionCoefficients": calibData.getDistortionCoefficients(dai.CameraBoardSocket.RGB)
+        }
+
+    def _on_message(self, *args):
+        self.data_event.set()
+
+    def _open_queues(self):
+        self.queues = {
+            name: self.device.getOutputQueue(name, maxSize=self.queue_size, blocking=False)
+            for name in STREAMS
+        }
+        for queue in self.queues.values():
+            queue.addCallback(self._on_message)
+
+    def get_queue(self, name):
+        return self.queues[name]
+
+    def wait(self, timeout=None):
+        """
+        Block until any stream receives a message. Returns False if the timeout expired.
+        """
+        received = self.data_event.wait(timeout)
+        # messages arriving after this are picked up by the caller's next read
+        self.data_event.clear()
+        return received
+
+    def clock(self):
+        """
+        Current time on the clock the message timestamps use.
+        """
+        return dai.Clock.now().total_seconds()
+
+    def restart(self):
+        """
+        Safely restarts the DepthAI pipeline and reinitializes the device and output queues.
+        """
+        # Close the existing device connection
+        self.device.close()
+        # Wait for the device to close
+        time.sleep(1)
+        # Reinitialize the device with the pipeline
+        self.device = dai.Device(self.pipeline, maxUsbSpeed=dai.UsbSpeed.SUPER_PLUS)
+        self.device.startPipeline()
+        # Recreate the output queues
+        self._open_queues()
+
+    def close(self):
+        self.device.close()
+
+
+class ReplayDetection:
+    """
+    Stand-in for dai.ImgDetection.
+    """
+
+    __slots__ = ("label", "confidence", "xmin", "ymin", "xmax", "ymax")
+
+    def __init__(self, label, confidence, xmin, ymin, xmax, ymax):
+        self.label = label
+        self.confidence = confidence
+        self.xmin = xmin
+        self.ymin = ymin
+        self.xmax = xmax
+        self.ymax = ymax
+
+
+class ReplayMessage:
+    """
+    Stand-in for dai.ImgFrame / dai.ImgDetections.
+    """
+
+    def __init__(self, seq, timestamp, frame=None, detections=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.frame = frame
+        self.detections = detections
+
+    def getSequenceNum(self):
+        return self.seq
+
+    def getTimestamp(self):
+        return timedelta(seconds=self.timestamp)
+
+    def getCvFrame(self):
+        # consumers draw on the frame, so hand out a copy
+        return self.frame.copy()
+
+
+class ReplayQueue:
+    """
+    Queue-like view of one stream of a ReplaySource, mirrors dai.DataOutputQueue.
+    """
+
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+        self.next = 0
+
+    def _message(self, index):
+        return self.source.message(self.name, index)
+
+    def has(self):
+        return self.next < self.source.due()
+
+    def tryGet(self):
+        if not self.has():
+            return None
+        self.next += 1
+        return self._message(self.next - 1)
+
+    def tryGetAll(self):
+        due = self.source.due()
+        # like a non-blocking device queue, only the newest messages are kept
+        start = max(self.next, due - self.source.queue_size)
+        self.next = max(self.next, due)
+        return [self._message(index) for index in range(start, due)]
+
+    def get(self, timeout=None):
+        """
+        Block until a message is available. Returns None if the timeout expires.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.has():
+            if not self.source.loop and self.next >= len(self.source.records):
+                return None
+            wait = self.source.time_until_next()
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            time.sleep(max(wait, 0.001))
+        return self.tryGet()
+
+
+class ReplaySource:
+    """
+    Frames and detections recorded by SessionRecorder, served through the same
+    queue-like API as DeviceSource so the rest of the pipeline runs without a camera.
+
+    realtime=True releases records at their original timing, otherwise a record is
+    released as soon as every stream has consumed the previous one.
+    """
+
+    def __init__(self, path, realtime=True, loop=False, queue_size=QUEUE_SIZE):
+        self.path = path
+        self.realtime = realtime
+        self.loop = loop
+        self.queue_size = queue_size
+        with open(os.path.join(path, "session.json"), "r") as f:
+            session = json.load(f)
+        self.intrinsics = session["intrinsics"]
+        self.labels = session.get("labels")
+        self.records = []
+        with open(os.path.join(path, "records.jsonl"), "r") as f:
+            for line in f:
+                if line.strip():
+                    self.records.append(json.loads(line))
+        if not self.records:
+            raise ValueError(f"No records in {path}")
+        # pace the replay on the host arrival times, device timestamps restart with the pipeline
+        start = self.records[0]["time"]
+        self.timestamps = [record["time"] - start for record in self.records]
+        frame_period = self.timestamps[-1] / (len(self.records) - 1) if len(self.records) > 1 else 0.1
+        # leave one frame period between the last record and the first one of the next loop
+        self.duration = self.timestamps[-1] + frame_period
+        self.frames = {}
+        self.restart()
+
+    def _load_frame(self, index):
+        frame = self.frames.get(index)
+        if frame is None:
+            file = os.path.join(self.path, self.records[index]["frame"])
+            frame = np.load(file) if file.endswith(".npy") else cv2.imread(file)
+            frame.setflags(write=False)
+            # keep the whole (small) recording in memory when looping
+            if self.loop:
+                self.frames[index] = frame
+        return frame
+
+    def message(self, name, index):
+        """
+        Build the message for the given stream and absolute record index.
+        """
+        loops, i = divmod(index, len(self.records))
+        record = self.records[i]
+        seq = record["seq"] + loops * len(self.records)
+        timestamp = record["timestamp"] + loops * self.duration
+        if name == "rgb":
+            return ReplayMessage(seq, timestamp, frame=self._load_frame(i))
+        detections = [ReplayDetection(**detection) for detection in record["detections"]]
+        return ReplayMessage(seq, timestamp, detections=detections)
+
+    def _total(self):
+        return float("inf") if self.loop else len(self.records)
+
+    def due(self):
+        """
+        Number of records released so far.
+        """
+        if not self.realtime:
+            return min(min(queue.next for queue in self.queues.values()) + 1, self._total())
+        elapsed = time.monotonic() - self.start
+        loops, offset = divmod(elapsed, self.duration) if self.loop else (0, elapsed)
+        due = int(loops) * len(self.records) + bisect.bisect_right(self.timestamps, offset)
+        return min(due, self._total())
+
+    def time_until_next(self):
+        if not self.realtime:
+            return 0
+        due = self.due()
+        loops, i = divmod(due, len(self.records))
+        if not self.loop and due >= len(self.records):
+            return float("inf")
+        return self.start + loops * self.duration + self.timestamps[i] - time.monotonic()
+
+    def finished(self):
+        return not self.loop and all(queue.next >= len(self.records) for queue in self.queues.values())
+
+    def get_queue(self, name):
+        return self.queues[name]
+
+    def clock(self):
+        # recorded timestamps are from the recording's device clock
+        return None
+
+    def wait(self, timeout=None):
+        """
+        Block until the next record is released. Returns False if the timeout expired first.
+        """
+        wait = self.time_until_next()
+        if self.finished() or wait == float("inf"):
+            # nothing left to replay, behave like an idle camera
+            if timeout is not None:
+                time.sleep(timeout)
+            return False
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(wait, 0))
+        return True
+
+    def restart(self):
+        """
+        Rewind to the start of the recording.
+        """
+        self.start = time.monotonic()
+        self.queues = {name: ReplayQueue(self, name) for name in STREAMS}
+
+    def close(self):
+        self.frames.clear()
+
+
+class SessionRecorder:
+    """
+    Writes matched frames and detections to disk in the format ReplaySource reads.
+
+    write() only queues the record, a background thread encodes the frame and
+    writes it, so recording does not stall the camera thread on a slow disk.
+    Frames are stored as image_format (".png" is lossless and several times
+    smaller than raw ".npy"). When the queue is full the frame is dropped, unless
+    block=True. close() writes out what is queued.
+    """
+
+    STOP = None
+
+    def __init__(self, path, intrinsics, labels=None, image_format=RECORD_FORMAT, queue_size=RECORD_QUEUE_SIZE, block=False):
+        self.path = path
+        self.image_format = image_format
+        self.block = block
+        os.makedirs(os.path.join(path, "frames"), exist_ok=True)
+        with open(os.path.join(path, "session.json"), "w") as f:
+            json.dump({"intrinsics": intrinsics, "labels": labels}, f)
+        self.records = open(os.path.join(path, "records.jsonl"), "w")
+        self.count = 0
+        self.closed = False
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.thread = Thread(target=self._run, name="session-recorder", daemon=True)
+        self.thread.start()
+
+    def write(self, frame, rgb_msg, nn_msg):
+        """
+        Record a raw frame (before annotation) with its matched messages.
+        """
+        if self.closed:
+            return
+        # device sequence numbers restart with the pipeline, number the records ourselves
+        seq = self.count
+        record = {
+            "seq": seq,
+            "device_seq": rgb_msg.getSequenceNum(),
+            "timestamp": rgb_msg.getTimestamp().total_seconds(),
+            "time": time.monotonic(),
+            "frame": os.path.join("frames", f"{seq:08d}{self.image_format}"),
+            "detections": [
+                {
+                    "label": detection.label,
+                    "confidence": detection.confidence,
+                    "xmin": detection.xmin,
+                    "ymin": detection.ymin,
+                    "xmax": detection.xmax,
+                    "ymax": detection.ymax,
+                }
+                for detection in nn_msg.detections
+            ],
+        }
+        try:
+            # the caller goes on to draw on its frame
+            self.pending.put((frame.copy(), record), block=self.block)
+        except queue.Full:
+            RECORD_DROPPED.inc()
+            return
+        self.count += 1
+
+    def _save(self, frame, record):
+        file = os.path.join(self.path, record["frame"])
+        if self.image_format == ".npy":
+            np.save(file, frame)
+        elif not cv2.imwrite(file, frame, RECORD_ENCODE_PARAMS.get(self.image_format, [])):
+            raise IOError(f"Could not write {file}")
+        self.records.write(json.dumps(record) + "\n")
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is self.STOP:
+                return
+            try:
+                self._save(*item)
+                if self.pending.empty():
+                    # readable by a replay as soon as the writes catch up
+                    self.records.flush()
+            except Exception as e:
+                RECORD_DROPPED.inc()
+                logging.error("Failed to record frame %s: %s", item[1]["seq"], e)
+
+    def close(self, timeout=10):
+        """
+        Write out the queued frames and close the session.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(self.STOP)
+        self.thread.join(timeout)
+        self.records.close()
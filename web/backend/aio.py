@@ -0,0 +1,227 @@
+"""
+Asyncio serving mode (SERVER_MODE=asyncio), an alternative to Flask's threaded
+server for the same routes.
+
+/video, /video/snapshot and /stream/telemetry are coroutines: clients wait on
+an asyncio event that the camera and sampling threads set through the loop's
+thread-safe call queue, so an idle viewer holds no thread and each new frame or
+record wakes the loop once however many clients are connected. Every other
+route is passed to the Flask app, which runs in the default executor.
+"""
+import io
+import sys
+import asyncio
+import logging
+
+from .broadcaster import FRAME_TIMEOUT
+from .telemetry import HEARTBEAT, HEARTBEAT_INTERVAL, format_event
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+# what flask_cors adds to the Flask routes
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+class AsyncSignal:
+    """
+    Wakes coroutines on an event loop from any thread.
+
+    Waiters take `event` before checking for new data and then wait on it, so a
+    notify() between the check and the wait is not missed.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def notify(self, *args):
+        try:
+            self.loop.call_soon_threadsafe(self._fire)
+        except RuntimeError:
+            # the loop has shut down
+            pass
+
+    def _fire(self):
+        event, self.event = self.event, asyncio.Event()
+        event.set()
+
+    async def wait(self, event, timeout):
+        """
+        Wait for event (taken from self.event), False on timeout.
+        """
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class AsyncServer:
+    def __init__(self, flask_app, video_feed, broadcaster, telemetry, backfill):
+        self.flask_app = flask_app
+        self.video_feed = video_feed
+        self.broadcaster = broadcaster
+        self.telemetry = telemetry
+        self.backfill = backfill
+        self.frames = None
+        self.records = None
+
+    async def _start(self, app):
+        loop = asyncio.get_running_loop()
+        self.frames = AsyncSignal(loop)
+        self.records = AsyncSignal(loop)
+        self.video_feed.add_listener(self.frames.notify)
+        self.telemetry.add_listener(self.records.notify)
+
+    async def video(self, request):
+        loop = asyncio.get_running_loop()
+        response = web.StreamResponse(headers={
+            **CORS_HEADERS,
+            "Content-Type": "multipart/x-mixed-replace; boundary=frame",
+        })
+        await response.prepare(request)
+        seq = 0
+        self.video_feed.add_viewer()
+        try:
+            while True:
+                event = self.frames.event
+                new_seq, frame = self.video_feed.wait_for_frame(seq, 0)
+                if new_seq == seq or frame is None:
+                    await self.frames.wait(event, FRAME_TIMEOUT)
+                    continue
+                seq = new_seq
+                # encoded once per frame and cached, off the loop in case this is the first viewer
+                frame_bytes = await loop.run_in_executor(None, self.broadcaster.encode, frame)
+                if frame_bytes is None:
+                    continue
+                await response.write(b'--frame\r\n'
+                                     b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        finally:
+            # client disconnected, the write raised or the handler was cancelled
+            self.video_feed.remove_viewer()
+
+    async def snapshot(self, request):
+        frame_bytes = await asyncio.get_running_loop().run_in_executor(None, self.broadcaster.snapshot)
+        if frame_bytes is None:
+            return web.json_response({"error": True, "data": "No frame available"}, status=503, headers=CORS_HEADERS)
+        return web.Response(body=frame_bytes, content_type="image/jpeg", headers=CORS_HEADERS)
+
+    async def telemetry_stream(self, request):
+        loop = asyncio.get_running_loop()
+        last_id = request.headers.get("Last-Event-ID", request.query.get("last_id"))
+        try:
+            last_id = int(last_id) if last_id is not None else None
+        except ValueError:
+            last_id = None
+
+        response = web.StreamResponse(headers={
+            **CORS_HEADERS,
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+        await response.prepare(request)
+        with self.telemetry.subscription():
+            # rows from before the in-memory history come from the database
+            pages = self.telemetry.backfill_pages(last_id, self.backfill)
+            while True:
+                rows = await loop.run_in_executor(None, next, pages, None)
+                if rows is None:
+                    break
+                await response.write("".join(format_event(row) for row in rows).encode())
+                last_id = rows[-1][0]
+            if last_id is None:
+                last_id = self.telemetry.newest_id()
+
+            while True:
+                event = self.records.event
+                records = self.telemetry.records_after(last_id, 0)
+                if not records:
+                    if not await self.records.wait(event, HEARTBEAT_INTERVAL):
+                        await response.write(HEARTBEAT.encode())
+                    continue
+                await response.write("".join(format_event(record) for record in records).encode())
+                last_id = records[-1][0]
+
+    async def wsgi(self, request):
+        """
+        Run the request through the Flask app on the executor, streaming its body.
+        """
+        loop = asyncio.get_running_loop()
+        environ = _environ(request, await request.read())
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        result = await loop.run_in_executor(None, self.flask_app, environ, start_response)
+        try:
+            response = web.StreamResponse(status=started["status"])
+            for name, value in started["headers"]:
+                response.headers.add(name, value)
+            await response.prepare(request)
+            chunks = iter(result)
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+            await response.write_eof()
+            return response
+        finally:
+            close = getattr(result, "close", None)
+            if close is not None:
+                await loop.run_in_executor(None, close)
+
+    def application(self):
+        app = web.Application()
+        app.on_startup.append(self._start)
+        app.router.add_get("/video", self.video)
+        app.router.add_get("/video/snapshot", self.snapshot)
+        app.router.add_get("/stream/telemetry", self.telemetry_stream)
+        app.router.add_route("*", "/{path:.*}", self.wsgi)
+        return app
+
+
+def _environ(request, body):
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": request.path,
+        "QUERY_STRING": request.query_string,
+        "SERVER_NAME": request.url.host or "",
+        "SERVER_PORT": str(request.url.port or ""),
+        "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+        "REMOTE_ADDR": request.remote or "",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name in set(request.headers.keys()):
+        key = name.upper().replace("-", "_")
+        value = ",".join(request.headers.getall(name))
+        if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[key] = value
+        else:
+            environ["HTTP_" + key] = value
+    return environ
+
+
+def serve(flask_app, video_feed, broadcaster, telemetry, backfill, host, port):
+    """
+    Serve until interrupted, blocking like app.run().
+    """
+    if web is None:
+        raise RuntimeError("SERVER_MODE=asyncio needs aiohttp installed")
+    server = AsyncServer(flask_app, video_feed, broadcaster, telemetry, backfill)
+    logging.info("Starting asyncio web server")
+    web.run_app(server.application(), host=host, port=int(port), print=None)
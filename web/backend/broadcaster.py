@@ -0,0 +1,66 @@
+import logging
+
+from target_acquisition.frame import JPEG_QUALITY
+
+FRAME_TIMEOUT = 1  # seconds
+
+
+class MJPEGBroadcaster:
+    """
+    Shares JPEG encoded frames from a VideoFeed between all connected clients.
+    Each frame caches its own encoding so it is encoded once no matter how many
+    clients are watching, clients wait on the feed for the next sequence number
+    instead of polling.
+    """
+
+    def __init__(self, video_feed, quality=JPEG_QUALITY):
+        self.video_feed = video_feed
+        self.quality = quality
+
+    def encode(self, frame):
+        try:
+            return frame.jpeg(self.quality)
+        except Exception as e:
+            logging.error("Failed to encode frame: %s", e)
+            return None
+
+    def get_jpeg(self, last_seq=-1, timeout=FRAME_TIMEOUT):
+        """
+        Wait for a frame newer than last_seq and return (seq, jpeg_bytes).
+        If the timeout expires the current (possibly unchanged) frame is returned.
+        """
+        seq, frame = self.video_feed.wait_for_frame(last_seq, timeout)
+        if frame is None:
+            return seq, None
+        return seq, self.encode(frame)
+
+    def snapshot(self):
+        """
+        Return the latest frame as JPEG without waiting for a new one.
+        """
+        # keep annotating for a while in case more snapshots follow
+        self.video_feed.request_frames()
+        frame = self.video_feed.get_frame()
+        if frame is None:
+            return None
+        return self.encode(frame)
+
+    def stream(self):
+        """
+        Generator yielding multipart MJPEG chunks as new frames arrive.
+        """
+        seq = 0
+        self.video_feed.add_viewer()
+        try:
+            while True:
+                new_seq, frame_bytes = self.get_jpeg(seq)
+                is_new = new_seq != seq
+                seq = new_seq
+                if frame_bytes is None or not is_new:
+                    logging.warning("No frame available to stream.")
+                    continue
+                yield (b'--frame\r\n'
+                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+        finally:
+            # runs when the client disconnects and the generator is closed
+            self.video_feed.remove_viewer()
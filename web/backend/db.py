@@ -0,0 +1,179 @@
+import time
+import logging
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+
+import psycopg2
+from psycopg2 import extensions
+
+from common import metrics
+
+POOL_MIN = 0  # connections opened up front, the rest are opened on first use and then kept
+POOL_MAX = 8
+ACQUIRE_TIMEOUT = 10  # seconds to wait for a free connection
+HEALTH_CHECK_INTERVAL = 30  # seconds a connection can sit idle before it is checked
+
+POOL_WAIT = metrics.histogram("db_pool_wait_seconds", "Time spent waiting for a pooled connection")
+POOL_IN_USE = metrics.gauge("db_pool_connections_in_use", "Pooled connections checked out")
+POOL_IDLE = metrics.gauge("db_pool_connections_idle", "Pooled connections open and waiting to be reused")
+POOL_DISCARDED = metrics.counter("db_pool_connections_discarded_total", "Broken connections closed by the pool")
+
+connect_args = None
+slots = None
+idle = []  # (connection, time.monotonic() it was released), most recently used last
+state_lock = Lock()
+in_use = 0
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def init_pool(config):
+    """
+    Set up the connection pool from the DB_* config values.
+    DB_POOL_MIN connections are opened straight away, the rest on demand, up
+    to DB_POOL_MAX. Connections that are given back stay open for reuse. The
+    database does not have to be up yet, the pool then starts empty.
+    """
+    global connect_args
+    global slots
+    minconn = int(config.get("DB_POOL_MIN", POOL_MIN))
+    maxconn = int(config.get("DB_POOL_MAX", POOL_MAX))
+    connect_args = dict(
+        host=config["DB_HOST"],
+        database=config["DB_NAME"],
+        user=config["DB_USER"],
+        password=config["DB_PASS"],
+    )
+    # at most maxconn connections exist, callers wait for a free one
+    slots = BoundedSemaphore(maxconn)
+    try:
+        for _ in range(minconn):
+            idle.append((psycopg2.connect(**connect_args), time.monotonic()))
+    except psycopg2.OperationalError as e:
+        logging.warning("Database unavailable, opening pooled connections on demand: %s", e)
+    POOL_IN_USE.set_function(lambda: in_use)
+    POOL_IDLE.set_function(lambda: len(idle))
+    logging.info("Database pool ready (%d-%d connections)", minconn, maxconn)
+
+
+def _healthy(conn, released):
+    if conn.closed:
+        return False
+    if time.monotonic() - released < HEALTH_CHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        logging.warning("Discarding broken database connection: %s", e)
+        return False
+
+
+def _take_idle():
+    """
+    The most recently released connection that still works, or None to open a new one.
+    Only reused connections are checked, a new connection has just proved itself.
+    """
+    while True:
+        with state_lock:
+            if not idle:
+                return None
+            conn, released = idle.pop()
+        if _healthy(conn, released):
+            return conn
+        POOL_DISCARDED.inc()
+        conn.close()
+
+
+def acquire(timeout=ACQUIRE_TIMEOUT):
+    """
+    Check out a healthy connection. It must be given back with release().
+    """
+    global in_use
+    start = time.perf_counter()
+    if not slots.acquire(timeout=timeout):
+        raise PoolTimeout("No database connection available")
+    try:
+        conn = _take_idle()
+        if conn is None:
+            conn = psycopg2.connect(**connect_args)
+    except Exception:
+        slots.release()
+        raise
+    POOL_WAIT.observe(time.perf_counter() - start)
+    with state_lock:
+        in_use += 1
+    return conn
+
+
+def release(conn, close=False):
+    """
+    Return a connection to the pool, closing it if it is broken.
+    """
+    global in_use
+    try:
+        if not close and not conn.closed:
+            # like psycopg2's pools: end an open transaction, drop a connection in an unknown state
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+    except psycopg2.Error:
+        close = True
+    try:
+        if close or conn.closed:
+            conn.close()
+        else:
+            with state_lock:
+                idle.append((conn, time.monotonic()))
+    finally:
+        with state_lock:
+            in_use -= 1
+        slots.release()
+
+
+@contextmanager
+def connection():
+    """
+    A pooled connection for the duration of the block. The transaction is
+    committed on success and rolled back on error.
+    """
+    conn = acquire()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except psycopg2.OperationalError:
+        broken = True
+        raise
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        release(conn, close=broken)
+
+
+@contextmanager
+def cursor():
+    """
+    A cursor on a pooled connection, see connection().
+    """
+    with connection() as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+
+def close_pool():
+    with state_lock:
+        conns = [conn for conn, _ in idle]
+        idle.clear()
+    for conn in conns:
+        conn.close()
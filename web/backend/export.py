@@ -0,0 +1,154 @@
+"""
+Streamed bulk export of the `data` table.
+
+Rows are read through a server-side (named) cursor, so only EXPORT_CHUNK rows
+are held in memory at a time however long the flight was, and each chunk is
+encoded and sent before the next one is fetched.
+"""
+import io
+import csv
+import uuid
+
+from . import db
+from .writer import DATA_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_CHUNK = 2000  # rows fetched from the server per round trip
+
+# JSON columns are exported as their text
+EXPORT_SELECT = ", ".join(f"{column}::text" if column == "enviro_stats" else column for column in DATA_COLUMNS)
+# rows are written in time order, so id order is time order and walks the primary
+# key instead of sorting the whole range
+EXPORT_SQL = f"SELECT {EXPORT_SELECT} FROM data WHERE time >= %s AND time < %s ORDER BY id"
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+if pa is not None:
+    ARROW_SCHEMA = pa.schema([
+        ("id", pa.int64()),
+        ("temperature", pa.float32()),
+        ("pressure", pa.float32()),
+        ("humidity", pa.float32()),
+        ("light", pa.float32()),
+        ("oxidised", pa.float32()),
+        ("reduced", pa.float32()),
+        ("nh3", pa.float32()),
+        ("valve_state", pa.bool_()),
+        ("aruco_id", pa.int32()),
+        ("aruco_pose_x", pa.float32()),
+        ("aruco_pose_y", pa.float32()),
+        ("aruco_pose_z", pa.float32()),
+        ("guage", pa.float32()),
+        ("time", pa.timestamp("us")),
+        ("enviro_stats", pa.string()),
+    ])
+
+
+def available_formats():
+    if pa is None:
+        return ["csv"]
+    return list(FORMATS)
+
+
+def _chunks(start, end, chunk_size):
+    """
+    Lists of rows between start and end. The pooled connection is held until
+    the generator finishes or is closed (e.g. the client disconnects).
+    """
+    with db.connection() as conn:
+        # named cursors live in the transaction and fetch from the server in batches
+        with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cur:
+            cur.itersize = chunk_size
+            cur.execute(EXPORT_SQL, (start, end))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    Write-only file that hands back what was written since the last take(),
+    for writers (pyarrow) that expect a file rather than producing bytes.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def export_csv(start, end, chunk_size=EXPORT_CHUNK):
+    buffer = io.StringIO()
+    out = csv.writer(buffer)
+    out.writerow(DATA_COLUMNS)
+    for rows in _chunks(start, end, chunk_size):
+        out.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # header only, the range was empty
+        yield buffer.getvalue()
+
+
+def _batch(rows):
+    columns = list(zip(*rows))
+    return pa.record_batch(
+        [pa.array(values, type=field.type) for values, field in zip(columns, ARROW_SCHEMA)],
+        schema=ARROW_SCHEMA,
+    )
+
+
+def export_arrow(start, end, parquet=False, chunk_size=EXPORT_CHUNK):
+    """
+    Arrow IPC stream, or Parquet with one row group per chunk.
+    """
+    sink = _ChunkSink()
+    if parquet:
+        writer = pq.ParquetWriter(sink, ARROW_SCHEMA, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, ARROW_SCHEMA)
+    for rows in _chunks(start, end, chunk_size):
+        if parquet:
+            writer.write_table(pa.Table.from_batches([_batch(rows)]))
+        else:
+            writer.write_batch(_batch(rows))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def export(fmt, start, end):
+    """
+    Generator of encoded chunks for fmt, one of available_formats().
+    """
+    if fmt == "csv":
+        return export_csv(start, end)
+    return export_arrow(start, end, parquet=(fmt == "parquet"))
@@ -0,0 +1,106 @@
+import os
+import json
+import sqlite3
+import logging
+from datetime import datetime
+from threading import Lock
+
+from .writer import DATA_COLUMNS, TIME_INDEX
+
+# next to the code, not the working directory, so every start finds the same journal
+JOURNAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telemetry_journal.sqlite3")
+
+
+class Journal:
+    """
+    Durable local log of telemetry rows, written by the sampling loop before
+    anything touches Postgres.
+
+    Rows are appended to a SQLite database in WAL mode, a small local write
+    that works whether or not the database server is up. The writer forwards
+    rows after the checkpoint and moves the checkpoint past them once they are
+    committed upstream, deleting them from the journal.
+    """
+
+    def __init__(self, path=JOURNAL_PATH):
+        self.path = path
+        self.lock = Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # WAL appends without rewriting pages, NORMAL only syncs on checkpoints and
+        # can lose the last few rows on power loss but never corrupts the journal
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, row TEXT NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS checkpoint (id INTEGER PRIMARY KEY CHECK (id = 0), last_id INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO checkpoint (id, last_id) VALUES (0, 0)")
+        # rows the database would not accept, kept for inspection instead of blocking the rest
+        self.conn.execute("CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, row TEXT NOT NULL, error TEXT, time TEXT)")
+        logging.info("Telemetry journal at %s holds %d unforwarded rows", path, self.pending())
+
+    def append(self, row):
+        """
+        Append a row (values in `data` column order, id first).
+        """
+        with self.lock:
+            self.conn.execute("INSERT INTO records (id, row) VALUES (?, ?)", (row[0], json.dumps(row, default=str)))
+
+    def read(self, limit):
+        """
+        Up to limit rows after the checkpoint, oldest first.
+        """
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT row FROM records WHERE id > (SELECT last_id FROM checkpoint) ORDER BY id LIMIT ?",
+                (limit,)
+            )
+            rows = [json.loads(row) for (row,) in cur.fetchall()]
+        for row in rows:
+            # rows journalled before a column was added
+            row.extend([None] * (len(DATA_COLUMNS) - len(row)))
+            if row[TIME_INDEX] is not None:
+                row[TIME_INDEX] = datetime.fromisoformat(row[TIME_INDEX])
+        return [tuple(row) for row in rows]
+
+    def forwarded(self, last_id):
+        """
+        Rows up to last_id are committed upstream: move the checkpoint and drop them.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("UPDATE checkpoint SET last_id = ? WHERE last_id < ?", (last_id, last_id))
+                self.conn.execute("DELETE FROM records WHERE id <= ?", (last_id,))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def dead_letter(self, row, error):
+        """
+        Keep a row that was rejected upstream, it is no longer forwarded once the
+        checkpoint moves past it.
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO dead_letters (id, row, error, time) VALUES (?, ?, ?, ?)",
+                (row[0], json.dumps(row, default=str), str(error), datetime.now().isoformat())
+            )
+
+    def pending(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT count(*) FROM records WHERE id > (SELECT last_id FROM checkpoint)"
+            ).fetchone()[0]
+
+    def last_id(self):
+        """
+        The highest id journalled so far, forwarded or not.
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT max(COALESCE((SELECT max(id) FROM records), 0), last_id) FROM checkpoint"
+            ).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+from datetime import datetime
+from threading import Thread, Event
+
+from common import metrics
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "database", "migrations")
+MAINTENANCE_INTERVAL = 60  # seconds between rollup/retention runs
+MIGRATE_RETRY_DELAY = 2  # seconds between migration attempts while the database is coming up
+# raw rows older than this (e.g. "30 days") are deleted once rolled up. Off by default:
+# the rollups keep only the enviro columns and guage, the rest of a deleted row is gone
+RAW_RETENTION = ""
+
+MAINTENANCE_SECONDS = metrics.histogram("db_maintenance_seconds", "Time to roll up and trim telemetry", buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60))
+MAINTENANCE_ERRORS = metrics.counter("db_maintenance_errors_total", "Failed rollup/retention runs")
+
+
+def migrate(conn, migrations_dir=MIGRATIONS_DIR):
+    """
+    Apply the .sql files in migrations_dir that have not been applied yet, in
+    name order, each in its own transaction. Applied files are recorded in
+    schema_migrations so this is safe to run on every start.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version TEXT PRIMARY KEY,"
+            " applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+        cur.execute("SELECT version FROM schema_migrations")
+        applied = {row[0] for row in cur.fetchall()}
+    conn.commit()
+
+    for name in sorted(os.listdir(migrations_dir)):
+        if not name.endswith(".sql") or name in applied:
+            continue
+        with open(os.path.join(migrations_dir, name), "r") as f:
+            sql = f.read()
+        logging.info("Applying database migration %s", name)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (name,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+class Maintenance:
+    """
+    Applies pending migrations, then periodically rolls raw telemetry up into
+    data_1m / data_1h and deletes raw rows past the retention period, see
+    telemetry_maintenance() in the migrations. Migrations are retried every
+    MIGRATE_RETRY_DELAY until they succeed, so the server can start while the
+    database is down; `migrated` is set once the schema is up to date.
+    """
+
+    def __init__(self, connection, interval=MAINTENANCE_INTERVAL, raw_retention=RAW_RETENTION):
+        # connection() is a context manager giving a connection that is committed
+        # at the end of the block, e.g. db.connection
+        self.connection = connection
+        self.interval = interval
+        self.raw_retention = raw_retention or None
+        self.migrated = Event()
+        self.stopping = Event()
+        self.thread = Thread(target=self._run, name="db-maintenance", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run_once(self):
+        if not self.migrated.is_set():
+            with self.connection() as conn:
+                migrate(conn)
+            self.migrated.set()
+        start = time.perf_counter()
+        # rows are timestamped with the sampling host's clock, roll up against the same clock
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT telemetry_maintenance(%s, %s::interval)", (datetime.now(), self.raw_retention))
+        MAINTENANCE_SECONDS.observe(time.perf_counter() - start)
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                MAINTENANCE_ERRORS.inc()
+                logging.error("Telemetry maintenance failed: %s", e)
+            # writes wait for the schema, do not leave them for a whole interval
+            self.stopping.wait(self.interval if self.migrated.is_set() else min(self.interval, MIGRATE_RETRY_DELAY))
+
+    def stop(self, timeout=5):
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
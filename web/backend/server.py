@@ -1,17 +1,28 @@
 import os
-import psycopg2
+import json
 import time
-import asyncio
+from datetime import datetime, timedelta
 
 from dotenv import dotenv_values
 from flask import Flask, jsonify, request, Response
 from flask_cors import CORS
 from threading import Thread, Lock
-from io import BytesIO
-from PIL import Image
 from .dummy import get_imagery_data, Video
-from sampling.sampling_tube import extend, retract
-from enviro.enviro import get_data as get_enviro_data, display_loop, init_hardware, VideoFeed, video_feed_loop, write_ip_address
+from .broadcaster import MJPEGBroadcaster
+from . import aio
+from . import db
+from .export import export, available_formats, FORMATS as EXPORT_FORMATS
+from .schema import Maintenance, MAINTENANCE_INTERVAL, RAW_RETENTION
+from .telemetry import TelemetryBroker, RecordIds, load_last_id
+from .writer import TelemetryWriter, BATCH_SIZE, FLUSH_INTERVAL, DATA_COLUMNS
+from .journal import Journal, JOURNAL_PATH
+from .payload import json_response, to_columns, wants_columns, SEPARATORS
+from common import metrics
+from sampling.sampling_tube import TubeScheduler, EXTEND_TIME, TUBE_COOLDOWN
+from sampling.trigger import PressureTrigger, PRESSURE_THRESHOLD, DEBOUNCE_READINGS
+from target_acquisition.sources import ReplaySource
+from enviro.sensors import SensorService
+from enviro.enviro import display_loop, init_hardware, VideoFeed, video_feed_loop, write_ip_address
 import logging
 import atexit
 import subprocess
@@ -20,17 +31,24 @@ import subprocess
 # Constants
 
 LOOP_DELAY = 1  # seconds
+DB_RETRY_DELAY = 2  # seconds between connection attempts at startup
+PAGE_SIZE = 500  # default rows per /data/enviro page
+MAX_PAGE_SIZE = 5000
+FETCH_SIZE = 100  # rows serialized per chunk
+SERIES_POINTS = 300  # default buckets per /data/enviro/series response
+MAX_SERIES_POINTS = 2000
+ENVIRO_COLUMNS = ("temperature", "pressure", "humidity", "light", "oxidised", "reduced", "nh3")
+IMAGERY_COLUMNS = ("valve_state", "aruco_id", "aruco_pose_x", "aruco_pose_y", "aruco_pose_z", "guage")
 
 # Global variables
 config = None
-conn = None
-cur = None
-vide_feed = None
-
-tube_state = "retracted"
-last_tube_time = None
-EXTEND_TIME = 5 # Seconds
-TUBE_COOLDOWN = 20 # Seconds
+video_feed = None
+broadcaster = None
+writer = None
+maintenance = None
+telemetry = TelemetryBroker()
+record_ids = None
+tube = None
 
 app = Flask(__name__)
 CORS(app)
@@ -51,81 +69,254 @@ def get_test():
     )
 
 
-@app.route("/data/all")
-def get_all():
-    global cur
-
-    limit = request.args.get("limit", 50)
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
 
-    cur.execute("SELECT * FROM data ORDER BY id DESC LIMIT %s", (limit,))
-    data = cur.fetchall()
 
-    return jsonify(
-        error=False,
-        data=data,
-    )
+@app.route("/data/all")
+def get_all():
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        limit = 50
+
+    # recent rows come from memory, only longer histories go to the database
+    data = telemetry.recent(limit)
+    if data is None:
+        with db.cursor() as cur:
+            cur.execute("SELECT * FROM data ORDER BY id DESC LIMIT %s", (limit,))
+            data = cur.fetchall()
+
+    if wants_columns():
+        return json_response(dict(error=False, data=to_columns(data, DATA_COLUMNS)), fast=True)
+    return json_response(dict(error=False, data=data))
+
+
+def stream_page(query, params, limit):
+    """
+    Stream a page of rows as {"error": false, "data": [...], "next": cursor}.
+    Rows are serialized in chunks as they are fetched, next is the id to pass
+    as start for the following page, or null if this was the last page.
+    """
+    with db.cursor() as cur:
+        cur.execute(query, params)
+        yield '{"error":false,"data":['
+        count = 0
+        last_id = None
+        while True:
+            rows = cur.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            chunk = ",".join(json.dumps(row, default=str, separators=SEPARATORS) for row in rows)
+            yield ("," if count else "") + chunk
+            count += len(rows)
+            last_id = rows[-1][0]
+        next_id = last_id if count == limit else None
+        yield f'],"next":{json.dumps(next_id)}}}'
 
 
 @app.route("/data/enviro")
 def get_enviro():
-    global cur
-
-    start = request.args.get("start", 0)
-    # try to convert to int, if not possible, default to 0
+    # keyset pagination: rows with id > start, at most limit of them
     try:
-        start = int(start)
+        start = int(request.args.get("start", 0))
     except ValueError:
         start = 0
+    try:
+        limit = int(request.args.get("limit", PAGE_SIZE))
+    except ValueError:
+        limit = PAGE_SIZE
+    limit = min(max(limit, 1), MAX_PAGE_SIZE)
+
+    if wants_columns():
+        # a page is bounded by MAX_PAGE_SIZE, so it can be built whole
+        columns = ("id", *ENVIRO_COLUMNS, "time")
+        with db.cursor() as cur:
+            cur.execute(
+                f"SELECT {', '.join(columns)} FROM data WHERE id > %s ORDER BY id ASC LIMIT %s",
+                (start, limit)
+            )
+            rows = cur.fetchall()
+        next_id = rows[-1][0] if len(rows) == limit else None
+        return json_response(dict(error=False, data=to_columns(rows, columns), next=next_id), fast=True)
 
-    cur.execute("SELECT * FROM enviro WHERE id > %s ORDER BY id ASC", (start,))
-    data = cur.fetchall()
+    return Response(
+        stream_page("SELECT * FROM enviro WHERE id > %s ORDER BY id ASC LIMIT %s", (start, limit), limit),
+        mimetype="application/json",
+    )
 
-    return jsonify(
-        error=False,
-        data=data,
+
+def parse_time(value):
+    """
+    Parse an ISO 8601 timestamp or unix epoch seconds, None if missing or invalid.
+    Rows are stored in naive local time, so timestamps with an offset are
+    converted to it.
+    """
+    if value is None:
+        return None
+    try:
+        return datetime.fromtimestamp(float(value))
+    except ValueError:
+        pass
+    except (OverflowError, OSError):
+        # a number, but not a representable time (e.g. 1e20, inf)
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone().replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
+        return None
+    return parsed
+
+
+def time_range_args():
+    """
+    The start and end query arguments, None where missing. Raises ValueError
+    for one that is given but not a valid time.
+    """
+    times = []
+    for name in ("start", "end"):
+        value = request.args.get(name)
+        parsed = parse_time(value)
+        if value is not None and parsed is None:
+            raise ValueError(f"{name} must be an ISO 8601 time or epoch seconds")
+        times.append(parsed)
+    return times
+
+
+@app.route("/data/enviro/series")
+def get_enviro_series():
+    """
+    Downsampled enviro data between start and end (defaults to the whole flight):
+    min/max/mean per column in at most `points` equal time buckets.
+    Invalid arguments are answered with 400, like /data/export.
+    """
+    try:
+        start, end = time_range_args()
+    except ValueError as e:
+        return jsonify(error=True, data=str(e)), 400
+    try:
+        points = int(request.args.get("points", SERIES_POINTS))
+    except ValueError:
+        return jsonify(error=True, data="points must be an integer"), 400
+    points = min(max(points, 1), MAX_SERIES_POINTS)
+
+    with db.cursor() as cur:
+        if start is None or end is None:
+            # rows are numbered in time order, the ends of the primary key are the
+            # first and last times without scanning the table
+            cur.execute(
+                "SELECT (SELECT time FROM data ORDER BY id ASC LIMIT 1),"
+                " (SELECT time FROM data ORDER BY id DESC LIMIT 1)"
+            )
+            first, last = cur.fetchone()
+            if first is None:
+                return jsonify(error=False, data=None)
+            start = start or first
+            # include the last row in the final bucket
+            end = end or last + timedelta(microseconds=1)
+        if end <= start:
+            return jsonify(error=True, data="end must be after start"), 400
+
+        bucket_seconds = (end - start).total_seconds() / points
+        aggregates = ", ".join(
+            f"min({column}), max({column}), avg({column})" for column in ENVIRO_COLUMNS
+        )
+        cur.execute(
+            f"""
+            SELECT floor(extract(epoch FROM time - %(start)s) / %(width)s)::int AS bucket, count(*), {aggregates}
+            FROM data
+            WHERE time >= %(start)s AND time < %(end)s
+            GROUP BY bucket
+            ORDER BY bucket
+            """,
+            {"start": start, "end": end, "width": bucket_seconds},
+        )
+        rows = cur.fetchall()
+
+    series = {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "bucket_seconds": bucket_seconds,
+        "time": [(start + timedelta(seconds=row[0] * bucket_seconds)).isoformat() for row in rows],
+        "count": [row[1] for row in rows],
+    }
+    for i, column in enumerate(ENVIRO_COLUMNS):
+        offset = 2 + i * 3
+        series[column] = {
+            "min": [row[offset] for row in rows],
+            "max": [row[offset + 1] for row in rows],
+            "mean": [row[offset + 2] for row in rows],
+        }
+
+    return json_response(dict(error=False, data=series), fast=wants_columns())
+
+
+@app.route("/data/export")
+def get_export():
+    """
+    Download every data row between start and end (defaults to everything) as
+    csv, or parquet / arrow when pyarrow is installed. Streamed in chunks so
+    memory use does not grow with the size of the flight.
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in available_formats():
+        return jsonify(
+            error=True,
+            data=f"format must be one of {', '.join(available_formats())}",
+        ), 400
+    try:
+        start, end = time_range_args()
+    except ValueError as e:
+        return jsonify(error=True, data=str(e)), 400
+    start = start or datetime.min
+    end = end or datetime.max
+
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = f"flight-{datetime.now():%Y%m%d-%H%M%S}.{extension}"
+    return Response(
+        export(fmt, start, end),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
 @app.route("/data/imagery")
 def get_imagery():
-    global cur
-
-    cur.execute("SELECT * FROM imagery ORDER BY id DESC LIMIT 1")
-        # id,
-        # valve_state,
-        # aruco_id,
-        # aruco_pose_x,
-        # aruco_pose_y,
-        # aruco_pose_z,
-        # guage
+    latest = telemetry.latest()
+    if latest is not None:
+        # id and the imagery columns of the newest data row
+        return imagery_response((latest[0], *latest[8:14]))
+
     try:
-        data = cur.fetchone()
+        with db.cursor() as cur:
+            cur.execute("SELECT * FROM imagery ORDER BY id DESC LIMIT 1")
+                # id,
+                # valve_state,
+                # aruco_id,
+                # aruco_pose_x,
+                # aruco_pose_y,
+                # aruco_pose_z,
+                # guage
+            data = cur.fetchone()
     except Exception as e:
         logging.error("Failed to get imagery data: %s", e)
         data = None
 
-    return jsonify(
-        error=False,
-        data=data,
-    )
+    return imagery_response(data)
+
+
+def imagery_response(row):
+    if wants_columns():
+        rows = [row] if row is not None else []
+        return json_response(dict(error=False, data=to_columns(rows, ("id", *IMAGERY_COLUMNS))), fast=True)
+    return json_response(dict(error=False, data=row))
 
 
 def video_gen():
-    while True:
-        frame = video_feed.get_frame()
-        if frame:
-            try:
-                # Assuming 'frame' is a PIL Image. If it's already bytes, adjust accordingly.
-                buffer = BytesIO()
-                frame.save(buffer, format='JPEG')
-                frame_bytes = buffer.getvalue()
-                yield (b'--frame\r\n'
-                       b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
-            except Exception as e:
-                logging.error("Failed to encode frame: %s", e)
-        else:
-            logging.warning("No frame available to stream.")
-        time.sleep(0.05)  # Adjust the sleep time as needed
+    yield from broadcaster.stream()
 
 
 @app.route("/video")
@@ -135,42 +326,94 @@ def get_video():
         mimetype="multipart/x-mixed-replace; boundary=frame"
     )
 
-async def handle_sampling_tube():
-    global tube_state
-    global last_tube_time
-    time_now = time.time()
-    if last_tube_time is not None and time_now - last_tube_time < TUBE_COOLDOWN:
-        logging.info("Tube is cooling down, skipping")
-        return
-    tube_state = "extended"
-    last_tube_time = time_now
-    extend()
-    await asyncio.sleep(EXTEND_TIME)
-    retract()
-    tube_state = "retracted"
 
-def read_all(bme280, ltr559, video_feed:VideoFeed):
-    global conn
-    global cur
+@app.route("/video/snapshot")
+def get_video_snapshot():
+    frame_bytes = broadcaster.snapshot()
+    if frame_bytes is None:
+        return jsonify(
+            error=True,
+            data="No frame available",
+        ), 503
+    return Response(frame_bytes, mimetype="image/jpeg")
+
+
+def backfill_telemetry(last_id, until_id):
+    """
+    Rows between last_id and until_id (None for no upper bound) for a client
+    resuming a stream from further back.
+    """
+    with db.cursor() as cur:
+        cur.execute(
+            "SELECT * FROM data WHERE id > %s AND (%s IS NULL OR id < %s) ORDER BY id ASC LIMIT %s",
+            (last_id, until_id, until_id, MAX_PAGE_SIZE)
+        )
+        return cur.fetchall()
+
+
+@app.route("/stream/telemetry")
+def get_telemetry_stream():
+    """
+    Server-Sent Events stream of telemetry rows (in `data` column order) as they are sampled.
+    Resumes after the standard Last-Event-ID header or ?last_id=.
+    """
+    last_id = request.headers.get("Last-Event-ID", request.args.get("last_id"))
+    try:
+        last_id = int(last_id) if last_id is not None else None
+    except ValueError:
+        last_id = None
+
+    return Response(
+        telemetry.stream(last_id, backfill_telemetry),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
+def load_record_ids(journal):
+    """
+    Row ids are assigned as records are sampled, carry on from what is stored.
+    A journal that has numbered rows before knows every id handed out, so sampling
+    can start without the database; a new one has to wait for the table's last id.
+    """
+    last_id = journal.last_id()
+    while True:
+        try:
+            with db.cursor() as cur:
+                last_id = max(last_id, load_last_id(cur))
+            break
+        except Exception as e:
+            if last_id:
+                logging.warning("Database unavailable at startup, journalling until it is back: %s", e)
+                break
+            logging.warning("Waiting for the database to number telemetry rows: %s", e)
+            time.sleep(DB_RETRY_DELAY)
+    return RecordIds(last_id)
+
+
+def read_all(sensors, video_feed:VideoFeed, journal):
+    global record_ids
+    # only sampling waits on a new journal, the hardware and web server are already up
+    record_ids = load_record_ids(journal)
+    # the first row aggregates from here, not over the wait
+    sensors.collect()
     next_time = time.time() + LOOP_DELAY
     while True:
         time.sleep(max(0, next_time - time.time()))
 
-        # Get data
-        enviro = get_enviro_data(bme280, ltr559)
-        video_details = video_feed.get_details()
-        if not video_details:
-            video_details = {}
-
-        pressure = video_details.get("pressure")
-        if pressure is not None and pressure < 2 and tube_state == "retracted":
-            asyncio.run(handle_sampling_tube())
-
-        # Insert data into database
-        cur.execute(
-            "INSERT INTO data (temperature, pressure, humidity, light, oxidised, reduced, nh3, valve_state, aruco_id, aruco_pose_x, aruco_pose_y, aruco_pose_z, guage) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            (
+        try:
+            # Get data
+            # aggregates of every reading since the last row, the mean is stored in the
+            # row itself, falling back to the latest reading if nothing was read
+            enviro_stats = sensors.collect()
+            enviro = sensors.latest().enviro()
+            enviro.update({column: stats["mean"] for column, stats in enviro_stats.items()})
+            video_details = video_feed.get_details()
+            if not video_details:
+                video_details = {}
+
+            record = (
+                record_ids.next(),
                 enviro.get("temperature"),
                 enviro.get("pressure"),
                 enviro.get("humidity"),
@@ -184,19 +427,28 @@ def read_all(bme280, ltr559, video_feed:VideoFeed):
                 video_details.get("aruco_pose_y"),
                 video_details.get("aruco_pose_z"),
                 video_details.get("pressure"),
+                datetime.now(),
+                enviro_stats or None,
             )
-        )
-        conn.commit()
+            # journal first so nothing is streamed that was not kept, the writer does the insert
+            writer.write(record)
+            telemetry.publish(record)
+        except Exception as e:
+            # keep sampling, a failed read only costs this sample
+            logging.exception("Failed to sample telemetry: %s", e)
 
         next_time += (time.time() - next_time) // LOOP_DELAY * LOOP_DELAY + LOOP_DELAY
 
 
 def main():
     global config
-    global conn
-    global cur
     global app
     global video_feed
+    global broadcaster
+    global writer
+    global maintenance
+    global record_ids
+    global tube
 
     # Load environment variables
     config = {
@@ -204,39 +456,76 @@ def main():
         **dotenv_values(".env")
     }
 
-    # Initialize database connection
-    conn = psycopg2.connect(
-        host=config["DB_HOST"],
-        database=config["DB_NAME"],
-        user=config["DB_USER"],
-        password=config["DB_PASS"],
-    )
-    cur = conn.cursor()
+    # Initialize database connection pool, shared by the request threads and the writer.
+    # Connections are opened on demand, the database does not have to be up yet
+    db.init_pool(config)
+
+    # Bring the schema up to date, then roll up and trim raw telemetry in the background
+    maintenance = Maintenance(
+        db.connection,
+        interval=float(config.get("DB_MAINTENANCE_INTERVAL", MAINTENANCE_INTERVAL)),
+        raw_retention=config.get("DB_RAW_RETENTION", RAW_RETENTION),
+    ).start()
+
+    # Every record goes to the local journal first and is forwarded from there
+    journal = Journal(os.path.abspath(config.get("JOURNAL_PATH", JOURNAL_PATH)))
+
+    # Telemetry is written from its own thread with its own connection
+    writer = TelemetryWriter(
+        journal,
+        db.acquire,
+        db.release,
+        batch_size=int(config.get("WRITER_BATCH_SIZE", BATCH_SIZE)),
+        flush_interval=float(config.get("WRITER_FLUSH_INTERVAL", FLUSH_INTERVAL)),
+        ready=maintenance.migrated,
+    ).start()
 
     # Get Hardware Handles
     bme280, ltr559, st7735_display = init_hardware()
+    # the only reader of the enviro sensors, everything else uses its snapshots
+    sensors = SensorService(bme280, ltr559, oversample=config.get("SENSOR_OVERSAMPLE", "0") == "1").start()
+    tube = TubeScheduler(
+        extend_time=float(config.get("TUBE_EXTEND_TIME", EXTEND_TIME)),
+        cooldown=float(config.get("TUBE_COOLDOWN", TUBE_COOLDOWN)),
+    ).start()
+    # fires the tube from gauge readings as the camera thread publishes them
+    PressureTrigger(
+        tube,
+        threshold=float(config.get("TUBE_TRIGGER_PRESSURE", PRESSURE_THRESHOLD)),
+        readings=int(config.get("TUBE_TRIGGER_READINGS", DEBOUNCE_READINGS)),
+    ).attach()
 
     # get video feed handle 
     video_feed = VideoFeed()
+    broadcaster = MJPEGBroadcaster(video_feed)
+    # replay a recorded session instead of using the camera, if configured
+    camera_source = None
+    if config.get("CAMERA_REPLAY"):
+        logging.info("Replaying camera session from %s", config["CAMERA_REPLAY"])
+        camera_source = ReplaySource(config["CAMERA_REPLAY"], loop=True)
     # start video feed thread
-    video_thread = Thread(target=video_feed_loop, args=(video_feed,), daemon=True)
+    video_thread = Thread(target=video_feed_loop, args=(video_feed, camera_source, config.get("CAMERA_RECORD")), daemon=True)
     video_thread.start()
 
     # Start display thread
-    display_thread = Thread(target=display_loop, args=(st7735_display, bme280, ltr559, video_feed), daemon=True)
+    display_thread = Thread(target=display_loop, args=(st7735_display, sensors, video_feed), daemon=True)
     display_thread.start()
 
     # Start reading data
-    thread = Thread(target=read_all, args=(bme280, ltr559, video_feed), daemon=True)
+    thread = Thread(target=read_all, args=(sensors, video_feed, journal), daemon=True)
     thread.start()
 
 
     def cleanup_at_exit():
         logging.info("Cleaning up database")
-        cur.close()
-        conn.close()
+        maintenance.stop()
+        writer.stop()
+        journal.close()
+        db.close_pool()
 
         logging.info("Cleaning up Hardware")
+        tube.stop()
+        sensors.stop()
         # write the ip address of the pi to the display
         write_ip_address(st7735_display)
 
@@ -244,5 +533,9 @@ def main():
 
 
     # Start web server
+    if config.get("SERVER_MODE") == "asyncio":
+        # streaming clients are coroutines instead of a thread each
+        aio.serve(app, video_feed, broadcaster, telemetry, backfill_telemetry, config["FLASK_HOST"], config["FLASK_PORT"])
+        return
     logging.info("Starting web server")
     app.run(host=config["FLASK_HOST"], port=config["FLASK_PORT"], debug=False)
@@ -0,0 +1,225 @@
+import json
+import logging
+from contextlib import contextmanager
+from threading import Condition
+
+from common import metrics
+
+HISTORY_SIZE = 600  # recent records kept in memory (10 minutes at 1 Hz)
+HEARTBEAT_INTERVAL = 15  # seconds between keep-alive comments on an idle stream
+HEARTBEAT = ": heartbeat\n\n"
+
+SUBSCRIBERS = metrics.gauge("telemetry_stream_subscribers", "Clients connected to the telemetry stream")
+PUBLISHED = metrics.counter("telemetry_records_published_total", "Telemetry records pushed to the stream")
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of the most recent records, oldest overwritten first.
+    Not thread safe on its own, the broker guards it.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.items = [None] * size
+        self.head = 0  # next slot to write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.items[self.head] = item
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.items[self.head - 1]
+
+    def oldest(self):
+        if not self.count:
+            return None
+        return self.items[(self.head - self.count) % self.size]
+
+    def recent(self, n):
+        """
+        Up to n of the newest items, newest first.
+        """
+        n = min(n, self.count)
+        return [self.items[(self.head - 1 - i) % self.size] for i in range(n)]
+
+    def after(self, last_id):
+        """
+        Items with id > last_id, oldest first. Items are in id order so this walks
+        back from the newest one.
+        """
+        items = []
+        for i in range(self.count):
+            item = self.items[(self.head - 1 - i) % self.size]
+            if item[0] <= last_id:
+                break
+            items.append(item)
+        items.reverse()
+        return items
+
+
+class TelemetryBroker:
+    """
+    Fans out telemetry records to streaming clients as read_all() produces them.
+
+    Records are rows in `data` column order, with the id the row is written
+    under. The most recent records are kept in a ring buffer, so clients that
+    reconnect with the last id they saw, and queries for the latest or recent
+    rows, are answered without touching the database.
+    """
+
+    def __init__(self, history_size=HISTORY_SIZE):
+        self.history = RingBuffer(history_size)
+        self.new_record = Condition()
+        self.subscribers = 0
+        # called with each record after it is published, from the sampling thread
+        self.listeners = []
+        SUBSCRIBERS.set_function(lambda: self.subscribers)
+
+    def publish(self, record):
+        with self.new_record:
+            self.history.append(record)
+            self.new_record.notify_all()
+        PUBLISHED.inc()
+        for listener in self.listeners:
+            listener(record)
+
+    def add_listener(self, listener):
+        """
+        Call listener(record) for every published record. It runs on the
+        sampling thread so it must not block.
+        """
+        self.listeners.append(listener)
+
+    @contextmanager
+    def subscription(self):
+        """
+        Counts a connected streaming client for the duration of the block.
+        """
+        with self.new_record:
+            self.subscribers += 1
+        try:
+            yield
+        finally:
+            with self.new_record:
+                self.subscribers -= 1
+
+    def oldest_id(self):
+        with self.new_record:
+            oldest = self.history.oldest()
+            return oldest[0] if oldest is not None else None
+
+    def latest(self):
+        """
+        The newest record, or None.
+        """
+        with self.new_record:
+            return self.history.latest()
+
+    def recent(self, n):
+        """
+        The newest n records newest first, or None if fewer than n are held in memory.
+        """
+        with self.new_record:
+            if n > len(self.history):
+                return None
+            return self.history.recent(n)
+
+    def records_after(self, last_id, timeout=None):
+        """
+        Records with id > last_id, waiting up to timeout for one to arrive.
+        """
+        with self.new_record:
+            self.new_record.wait_for(lambda: self._newest_id() > last_id, timeout)
+            return self.history.after(last_id)
+
+    def _newest_id(self):
+        latest = self.history.latest()
+        return latest[0] if latest is not None else 0
+
+    def stream(self, last_id=None, backfill=None):
+        """
+        Generator of Server-Sent Events.
+
+        last_id: id of the last record the client has, records after it are sent
+            first. None starts from the next new record.
+        backfill(last_id, until_id): returns rows missed before the in-memory history
+            starts, used when a client resumes from further back.
+        """
+        with self.subscription():
+            for rows in self.backfill_pages(last_id, backfill):
+                for row in rows:
+                    yield format_event(row)
+                last_id = rows[-1][0]
+            if last_id is None:
+                last_id = self.newest_id()
+            while True:
+                records = self.records_after(last_id, HEARTBEAT_INTERVAL)
+                if not records:
+                    # keeps proxies and the browser from closing an idle stream
+                    yield HEARTBEAT
+                    continue
+                for record in records:
+                    yield format_event(record)
+                last_id = records[-1][0]
+
+    def backfill_pages(self, last_id, backfill):
+        """
+        Generator of the lists of rows returned by backfill(last_id, until_id),
+        covering last_id up to the start of the in-memory history. until_id is
+        None while the history is empty (e.g. just after a restart), every
+        stored row after last_id is missing then. Nothing if last_id is None.
+        """
+        while backfill is not None and last_id is not None:
+            oldest = self.oldest_id()
+            if oldest is not None and last_id >= oldest - 1:
+                break
+            rows = backfill(last_id, oldest)
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][0]
+
+    def newest_id(self):
+        with self.new_record:
+            return self._newest_id()
+
+
+def format_event(record):
+    """
+    A record as a Server-Sent Event, with its id as the event id.
+    """
+    return f"id: {record[0]}\ndata: {json.dumps(record, default=str)}\n\n"
+
+
+class RecordIds:
+    """
+    Hands out `data` row ids in the sampling loop, so a record has its final id
+    before it is written and can be streamed straight away. This process is the
+    only writer of `data`; the writer moves the table's sequence along with it.
+    """
+
+    def __init__(self, last_id=0):
+        self.last_id = last_id
+
+    def next(self):
+        self.last_id += 1
+        return self.last_id
+
+
+def load_last_id(cur):
+    # the sequence covers ids of rows since deleted by retention
+    cur.execute(
+        "SELECT GREATEST(COALESCE(max(id), 0),"
+        " (SELECT last_value FROM data_id_seq WHERE is_called)) FROM data"
+    )
+    last_id = cur.fetchone()[0]
+    logging.info("Telemetry ids continue from %d", last_id)
+    return last_id
@@ -0,0 +1,218 @@
+import time
+import logging
+from threading import Thread, Event
+
+import psycopg2
+from psycopg2 import errors
+from psycopg2.extensions import register_adapter
+from psycopg2.extras import execute_values, Json
+
+from common import metrics
+
+BATCH_SIZE = 100  # rows per INSERT
+FLUSH_INTERVAL = 0  # seconds to wait for more rows before writing a batch
+RETRY_DELAY = 1  # seconds
+# attempts at a batch the database rejects before it is split up and the rows it
+# still rejects are dead-lettered
+REJECT_ATTEMPTS = 10
+
+# in `data` table order
+DATA_COLUMNS = (
+    "id",
+    "temperature",
+    "pressure",
+    "humidity",
+    "light",
+    "oxidised",
+    "reduced",
+    "nh3",
+    "valve_state",
+    "aruco_id",
+    "aruco_pose_x",
+    "aruco_pose_y",
+    "aruco_pose_z",
+    "guage",
+    "time",
+    "enviro_stats",
+)
+TIME_INDEX = DATA_COLUMNS.index("time")
+
+# enviro_stats is a dict, stored as JSONB
+register_adapter(dict, Json)
+# rows are forwarded at least once, a row committed before a crash is skipped on replay
+INSERT_SQL = f"INSERT INTO data ({', '.join(DATA_COLUMNS)}) VALUES %s ON CONFLICT (id) DO NOTHING"
+# ids are assigned by the sampling loop, keep the serial in step for anything else inserting.
+# Only ever moved forward, replayed or late rows must not wind it back
+SEQUENCE_SQL = "SELECT setval('data_id_seq', %(id)s) FROM data_id_seq WHERE last_value < %(id)s OR NOT is_called"
+
+ROWS_WRITTEN = metrics.counter("writer_rows_total", "Telemetry rows committed to the database")
+ROWS_SKIPPED = metrics.counter("writer_rows_skipped_total", "Forwarded rows whose id was already in the database")
+WRITE_ERRORS = metrics.counter("writer_errors_total", "Failed batch writes")
+ROWS_DEAD_LETTERED = metrics.counter("writer_rows_dead_lettered_total", "Rows the database rejected, moved to the journal's dead letters")
+BATCH_ROWS = metrics.histogram("writer_batch_rows", "Rows per committed batch", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+FLUSH_SECONDS = metrics.histogram("writer_flush_seconds", "Time to insert and commit a batch")
+BACKLOG = metrics.gauge("writer_backlog_rows", "Journalled telemetry rows not yet in the database")
+
+
+class TelemetryWriter:
+    """
+    Forwards journalled telemetry rows to the database from a dedicated thread.
+
+    write() appends to the local journal, so the sampling loop never waits on
+    the database and keeps its data while the database is down. The writer
+    thread takes the rows after the journal's checkpoint (up to batch_size,
+    waiting at most flush_interval for more), inserts them with a single
+    statement and commit, and only then moves the checkpoint. While the database
+    is unreachable rows build up in the journal and are sent in bulk once it is back.
+
+    Nothing is forwarded until `ready` (e.g. Maintenance.migrated) is set, rows
+    written against an old schema would be rejected. Connection failures and a
+    missing table or column are retried indefinitely. A batch the database
+    itself rejects is retried REJECT_ATTEMPTS times, then written row by row and
+    the rows that still fail are moved to the journal's dead letters, so one
+    bad row cannot hold back everything sampled after it.
+    """
+
+    def __init__(self, journal, connect, release=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, ready=None):
+        # connect() returns a database connection owned by the writer thread,
+        # release(conn, close) hands it back (e.g. to a pool), by default it is closed
+        self.journal = journal
+        self.connect = connect
+        self.release = release
+        self.ready = ready
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.wake = Event()
+        self.stopping = Event()
+        self.conn = None
+        self.rejected = 0  # consecutive rejections of the current batch
+        self.thread = Thread(target=self._run, name="telemetry-writer", daemon=True)
+        BACKLOG.set_function(self.journal.pending)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def write(self, row):
+        """
+        Journal a row (values in DATA_COLUMNS order) for forwarding.
+        """
+        self.journal.append(row)
+        self.wake.set()
+
+    def _next_batch(self):
+        """
+        Rows after the checkpoint, waiting for at least one.
+        """
+        self.wake.clear()
+        batch = self.journal.read(self.batch_size)
+        if not batch:
+            self.wake.wait(RETRY_DELAY)
+            return []
+        if len(batch) < self.batch_size and self.flush_interval > 0:
+            self.stopping.wait(self.flush_interval)
+            batch = self.journal.read(self.batch_size)
+        return batch
+
+    def _flush(self, batch):
+        if self.conn is not None and self.conn.closed:
+            self._release(close=True)
+        if self.conn is None:
+            self.conn = self.connect()
+        start = time.perf_counter()
+        try:
+            with self.conn.cursor() as cur:
+                execute_values(cur, INSERT_SQL, batch, page_size=len(batch))
+                inserted = cur.rowcount
+                cur.execute(SEQUENCE_SQL, {"id": max(row[0] for row in batch)})
+            self.conn.commit()
+        except Exception:
+            try:
+                self.conn.rollback()
+            except Exception:
+                # connection is gone, reconnect on the next attempt
+                self._release(close=True)
+            raise
+        FLUSH_SECONDS.observe(time.perf_counter() - start)
+        BATCH_ROWS.observe(len(batch))
+        ROWS_WRITTEN.inc(inserted)
+        if inserted < len(batch):
+            # expected only when replaying rows committed just before a crash
+            ROWS_SKIPPED.inc(len(batch) - inserted)
+            logging.warning("%d of %d telemetry rows were already stored, skipped", len(batch) - inserted, len(batch))
+
+    def _release(self, close=False):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if self.release is not None:
+            self.release(conn, close=close)
+        elif not conn.closed:
+            conn.close()
+
+    def _flush_rows(self, batch):
+        """
+        Write the rows of a rejected batch one at a time, dead-lettering the ones
+        the database rejects. Connection failures are raised.
+        """
+        for row in batch:
+            try:
+                self._flush([row])
+            except Exception as e:
+                if _transient(e):
+                    raise
+                ROWS_DEAD_LETTERED.inc()
+                logging.error("Telemetry row %s rejected, moved to dead letters: %s", row[0], e)
+                self.journal.dead_letter(row, e)
+
+    def _run(self):
+        logging.info("Starting telemetry writer.")
+        if self.ready is not None and not self.ready.is_set():
+            logging.info("Telemetry writer waiting for the database schema.")
+            while not self.ready.wait(RETRY_DELAY):
+                if self.stopping.is_set():
+                    # still in the journal, sent on the next start
+                    return
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if self.stopping.is_set():
+                    return
+                continue
+            try:
+                if self.rejected >= REJECT_ATTEMPTS:
+                    self._flush_rows(batch)
+                else:
+                    self._flush(batch)
+                self.journal.forwarded(batch[-1][0])
+                self.rejected = 0
+            except Exception as e:
+                WRITE_ERRORS.inc()
+                if not _transient(e):
+                    self.rejected += 1
+                logging.error("Failed to write %d telemetry rows, retrying: %s", len(batch), e)
+                if self.stopping.is_set():
+                    # still in the journal, sent on the next start
+                    return
+                time.sleep(RETRY_DELAY)
+
+    def stop(self, timeout=5):
+        """
+        Forward what is journalled and stop the writer thread.
+        """
+        self.stopping.set()
+        self.wake.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+        self._release()
+
+
+def _transient(error):
+    """
+    True for failures worth retrying as they are (connection loss, pool timeouts,
+    serialization failures, a schema still being migrated), False when the
+    database rejected the data or statement.
+    """
+    if not isinstance(error, psycopg2.Error):
+        return True
+    return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError, errors.UndefinedTable, errors.UndefinedColumn))
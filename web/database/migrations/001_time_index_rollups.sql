@@ -0,0 +1,193 @@
+-- Time index, rollup tables and retention for the telemetry table.
+--
+-- `data` stays a plain table so this applies to an existing database without
+-- rewriting it; a BRIN index on time keeps time range queries cheap since rows
+-- are inserted in time order. Raw rows are rolled up into 1 minute and 1 hour
+-- aggregates by telemetry_maintenance(), which can then drop old raw rows if
+-- given a retention period. The rollups only keep the enviro columns and guage.
+
+CREATE INDEX IF NOT EXISTS data_time_brin ON data USING BRIN (time);
+
+-- 1 minute aggregates of data
+CREATE TABLE IF NOT EXISTS data_1m (
+    bucket TIMESTAMP PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    temperature_min REAL,
+    temperature_max REAL,
+    temperature_avg REAL,
+    pressure_min REAL,
+    pressure_max REAL,
+    pressure_avg REAL,
+    humidity_min REAL,
+    humidity_max REAL,
+    humidity_avg REAL,
+    light_min REAL,
+    light_max REAL,
+    light_avg REAL,
+    oxidised_min REAL,
+    oxidised_max REAL,
+    oxidised_avg REAL,
+    reduced_min REAL,
+    reduced_max REAL,
+    reduced_avg REAL,
+    nh3_min REAL,
+    nh3_max REAL,
+    nh3_avg REAL,
+    guage_min REAL,
+    guage_max REAL,
+    guage_avg REAL
+);
+
+-- 1 hour aggregates of data_1m
+CREATE TABLE IF NOT EXISTS data_1h (
+    bucket TIMESTAMP PRIMARY KEY,
+    samples INTEGER NOT NULL,
+    temperature_min REAL,
+    temperature_max REAL,
+    temperature_avg REAL,
+    pressure_min REAL,
+    pressure_max REAL,
+    pressure_avg REAL,
+    humidity_min REAL,
+    humidity_max REAL,
+    humidity_avg REAL,
+    light_min REAL,
+    light_max REAL,
+    light_avg REAL,
+    oxidised_min REAL,
+    oxidised_max REAL,
+    oxidised_avg REAL,
+    reduced_min REAL,
+    reduced_max REAL,
+    reduced_avg REAL,
+    nh3_min REAL,
+    nh3_max REAL,
+    nh3_avg REAL,
+    guage_min REAL,
+    guage_max REAL,
+    guage_avg REAL
+);
+
+-- how far each rollup has got: buckets before done_until, and raw rows up to
+-- done_id (the writer inserts rows in id order)
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name TEXT PRIMARY KEY,
+    done_until TIMESTAMP NOT NULL,
+    done_id INTEGER NOT NULL DEFAULT 0
+);
+
+-- Roll up complete minutes and hours before `until` and delete raw rows older
+-- than `raw_retention` (NULL keeps them). Rows inserted since the last run may be
+-- older than what is already rolled up (e.g. written late after a database
+-- outage), so rollups are recomputed from the oldest of them. Late rows already
+-- past the retention period are deleted without being rolled up, their minutes
+-- no longer have the raw rows to recompute from.
+CREATE OR REPLACE FUNCTION telemetry_maintenance(
+    until TIMESTAMP,
+    raw_retention INTERVAL DEFAULT NULL
+) RETURNS VOID AS $$
+DECLARE
+    last_id INTEGER;
+    seen_id INTEGER;
+    minute_from TIMESTAMP;
+    minute_until TIMESTAMP := date_trunc('minute', until);
+    hour_from TIMESTAMP;
+    hour_until TIMESTAMP := date_trunc('hour', until);
+    -- raw rows before this are deleted, minute aligned so the minutes after it
+    -- always have all their raw rows. NULL without retention (LEAST skips NULLs)
+    raw_until TIMESTAMP := CASE WHEN raw_retention IS NOT NULL
+        THEN date_trunc('minute', LEAST(until - raw_retention, minute_until)) END;
+BEGIN
+    -- rows committed after this are left for the next run
+    SELECT max(id) INTO last_id FROM data;
+    SELECT done_until, done_id INTO minute_from, seen_id FROM rollup_state WHERE name = 'data_1m';
+    IF minute_from IS NOT NULL THEN
+        SELECT LEAST(minute_from, date_trunc('minute', min(time))) INTO minute_from
+            FROM data WHERE id > seen_id AND id <= last_id;
+        minute_from := GREATEST(minute_from, raw_until);
+    END IF;
+    INSERT INTO data_1m (
+            bucket, samples,
+            temperature_min, temperature_max, temperature_avg,
+            pressure_min, pressure_max, pressure_avg,
+            humidity_min, humidity_max, humidity_avg,
+            light_min, light_max, light_avg,
+            oxidised_min, oxidised_max, oxidised_avg,
+            reduced_min, reduced_max, reduced_avg,
+            nh3_min, nh3_max, nh3_avg,
+            guage_min, guage_max, guage_avg
+        )
+        SELECT date_trunc('minute', time), count(*),
+            min(temperature), max(temperature), avg(temperature),
+            min(pressure), max(pressure), avg(pressure),
+            min(humidity), max(humidity), avg(humidity),
+            min(light), max(light), avg(light),
+            min(oxidised), max(oxidised), avg(oxidised),
+            min(reduced), max(reduced), avg(reduced),
+            min(nh3), max(nh3), avg(nh3),
+            min(guage), max(guage), avg(guage)
+        FROM data
+        WHERE time >= COALESCE(minute_from, '-infinity') AND time < minute_until AND id <= last_id
+        GROUP BY 1
+        ON CONFLICT (bucket) DO UPDATE SET
+            samples = EXCLUDED.samples,
+            temperature_min = EXCLUDED.temperature_min, temperature_max = EXCLUDED.temperature_max, temperature_avg = EXCLUDED.temperature_avg,
+            pressure_min = EXCLUDED.pressure_min, pressure_max = EXCLUDED.pressure_max, pressure_avg = EXCLUDED.pressure_avg,
+            humidity_min = EXCLUDED.humidity_min, humidity_max = EXCLUDED.humidity_max, humidity_avg = EXCLUDED.humidity_avg,
+            light_min = EXCLUDED.light_min, light_max = EXCLUDED.light_max, light_avg = EXCLUDED.light_avg,
+            oxidised_min = EXCLUDED.oxidised_min, oxidised_max = EXCLUDED.oxidised_max, oxidised_avg = EXCLUDED.oxidised_avg,
+            reduced_min = EXCLUDED.reduced_min, reduced_max = EXCLUDED.reduced_max, reduced_avg = EXCLUDED.reduced_avg,
+            nh3_min = EXCLUDED.nh3_min, nh3_max = EXCLUDED.nh3_max, nh3_avg = EXCLUDED.nh3_avg,
+            guage_min = EXCLUDED.guage_min, guage_max = EXCLUDED.guage_max, guage_avg = EXCLUDED.guage_avg;
+    INSERT INTO rollup_state (name, done_until, done_id) VALUES ('data_1m', minute_until, COALESCE(last_id, seen_id, 0))
+        ON CONFLICT (name) DO UPDATE SET done_until = EXCLUDED.done_until, done_id = EXCLUDED.done_id;
+
+    -- every hour with a recomputed minute
+    SELECT done_until INTO hour_from FROM rollup_state WHERE name = 'data_1h';
+    IF minute_from IS NULL THEN
+        hour_from := NULL;
+    ELSE
+        hour_from := LEAST(hour_from, date_trunc('hour', minute_from));
+    END IF;
+    INSERT INTO data_1h (
+            bucket, samples,
+            temperature_min, temperature_max, temperature_avg,
+            pressure_min, pressure_max, pressure_avg,
+            humidity_min, humidity_max, humidity_avg,
+            light_min, light_max, light_avg,
+            oxidised_min, oxidised_max, oxidised_avg,
+            reduced_min, reduced_max, reduced_avg,
+            nh3_min, nh3_max, nh3_avg,
+            guage_min, guage_max, guage_avg
+        )
+        SELECT date_trunc('hour', bucket), sum(samples),
+            min(temperature_min), max(temperature_max), sum(temperature_avg * samples) / NULLIF(sum(samples) FILTER (WHERE temperature_avg IS NOT NULL), 0),
+            min(pressure_min), max(pressure_max), sum(pressure_avg * samples) / NULLIF(sum(samples) FILTER (WHERE pressure_avg IS NOT NULL), 0),
+            min(humidity_min), max(humidity_max), sum(humidity_avg * samples) / NULLIF(sum(samples) FILTER (WHERE humidity_avg IS NOT NULL), 0),
+            min(light_min), max(light_max), sum(light_avg * samples) / NULLIF(sum(samples) FILTER (WHERE light_avg IS NOT NULL), 0),
+            min(oxidised_min), max(oxidised_max), sum(oxidised_avg * samples) / NULLIF(sum(samples) FILTER (WHERE oxidised_avg IS NOT NULL), 0),
+            min(reduced_min), max(reduced_max), sum(reduced_avg * samples) / NULLIF(sum(samples) FILTER (WHERE reduced_avg IS NOT NULL), 0),
+            min(nh3_min), max(nh3_max), sum(nh3_avg * samples) / NULLIF(sum(samples) FILTER (WHERE nh3_avg IS NOT NULL), 0),
+            min(guage_min), max(guage_max), sum(guage_avg * samples) / NULLIF(sum(samples) FILTER (WHERE guage_avg IS NOT NULL), 0)
+        FROM data_1m
+        WHERE bucket >= COALESCE(hour_from, '-infinity') AND bucket < hour_until
+        GROUP BY 1
+        ON CONFLICT (bucket) DO UPDATE SET
+            samples = EXCLUDED.samples,
+            temperature_min = EXCLUDED.temperature_min, temperature_max = EXCLUDED.temperature_max, temperature_avg = EXCLUDED.temperature_avg,
+            pressure_min = EXCLUDED.pressure_min, pressure_max = EXCLUDED.pressure_max, pressure_avg = EXCLUDED.pressure_avg,
+            humidity_min = EXCLUDED.humidity_min, humidity_max = EXCLUDED.humidity_max, humidity_avg = EXCLUDED.humidity_avg,
+            light_min = EXCLUDED.light_min, light_max = EXCLUDED.light_max, light_avg = EXCLUDED.light_avg,
+            oxidised_min = EXCLUDED.oxidised_min, oxidised_max = EXCLUDED.oxidised_max, oxidised_avg = EXCLUDED.oxidised_avg,
+            reduced_min = EXCLUDED.reduced_min, reduced_max = EXCLUDED.reduced_max, reduced_avg = EXCLUDED.reduced_avg,
+            nh3_min = EXCLUDED.nh3_min, nh3_max = EXCLUDED.nh3_max, nh3_avg = EXCLUDED.nh3_avg,
+            guage_min = EXCLUDED.guage_min, guage_max = EXCLUDED.guage_max, guage_avg = EXCLUDED.guage_avg;
+    INSERT INTO rollup_state (name, done_until) VALUES ('data_1h', hour_until)
+        ON CONFLICT (name) DO UPDATE SET done_until = EXCLUDED.done_until;
+
+    -- only rows that are already rolled up can go
+    IF raw_retention IS NOT NULL THEN
+        DELETE FROM data WHERE time < raw_until AND id <= last_id;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,4 @@
+-- Per-row aggregates of the sensor readings taken since the previous row:
+-- {"<column>": {"n": .., "min": .., "max": .., "mean": .., "std": ..}, ...}.
+-- Nullable without a default, so adding it does not rewrite the table.
+ALTER TABLE data ADD COLUMN IF NOT EXISTS enviro_stats JSONB;
@@ -2,14 +2,12 @@ import { useEffect, useState } from "react";
 import { Card, CardBody, CardHeader, DropdownItem, DropdownMenu, DropdownToggle, InputGroup, UncontrolledDropdown } from "reactstrap";
 import { Multiselect } from "multiselect-react-dropdown";
 import { Line } from "react-chartjs-2";
-import { useSelector } from "react-redux";
-import { getServerURL } from "./common";
+import { getServerURL, subscribeTelemetry } from "./common";
 import "chart.js/auto";
 import "./Graph.css";
 
 export default function Graph() {
     const [data, setData] = useState(undefined)
-    const rate = useSelector(state => state.rate)
     const [entries, setEntries] = useState(30)
     const [selected, setSelected] = useState([
         { name: 'Temperature', id: 1 },
@@ -64,9 +62,12 @@ export default function Graph() {
     let results = []
 
     async function getData() {
+        // only the newest rows are drawn, the live stream brings the rest. Not
+        // /data/enviro/series: its buckets span the whole flight, and raw rows
+        // from the stream cannot be appended to bucket means
         const url = getServerURL()
-        url.pathname = '/data/enviro'
-        url.searchParams.append('start', start)
+        url.pathname = '/data/all'
+        url.searchParams.set('limit', entries)
 
         const response = await fetch(url)
         const json = await response.json()
@@ -75,11 +76,16 @@ export default function Graph() {
             return
         }
 
-        results = results.concat(json.data)
-        results = results.slice(-entries)
+        // newest first, the enviro columns follow the id
+        results = json.data.reverse().map(d => d.slice(0, 8))
+        if (results.length)
+            start = results[results.length - 1][0]
 
+        draw()
+    }
+
+    function draw() {
         const id = results.map(d => d[0])
-        start = id[id.length - 1]
 
         const sets = [];
         selected.forEach(s => {
@@ -99,11 +105,25 @@ export default function Graph() {
     }
 
     useEffect(() => {
-        const interval = setInterval(() => {
-            getData()
-        }, rate)
-        return () => clearInterval(interval)
-    }, [rate, entries, selected])
+        let closed = false
+        let unsubscribe = () => {}
+        // catch up from the database, then follow the live stream
+        getData().then(() => {
+            if (closed)
+                return
+            unsubscribe = subscribeTelemetry(record => {
+                if (record[0] <= start)
+                    return
+                start = record[0]
+                results = results.concat([record.slice(0, 8)]).slice(-entries)
+                draw()
+            })
+        })
+        return () => {
+            closed = true
+            unsubscribe()
+        }
+    }, [entries, selected])
 
     return (
         <Card className="m-3">
@@ -1,6 +1,6 @@
 import { useEffect, useState } from "react";
 import { Card, CardBody, CardHeader } from "reactstrap";
-import { getServerURL } from "./common";
+import { getServerURL, subscribeTelemetry } from "./common";
 import { useSelector } from "react-redux";
 import Speech from "speak-tts";
 
@@ -32,7 +32,6 @@ export default function Imagery() {
     const [lastArucoID, setLastArucoID] = useState(null)
     const [lastPressureValue, setLastPressureValue] = useState(null)
 
-    const rate = useSelector(state => state.rate)
     const mute = useSelector(state => state.mute)
 
     function speak(text) {
@@ -62,6 +61,11 @@ export default function Imagery() {
         if (!json.data)
             json.data = [null, null, null, null, null, null, null]
 
+        update(json)
+    }
+
+    function update(json) {
+
         if (json.data[1] !== null) {
             if (lastValveState !== json.data[1]) {
                 setLastValveState(json.data[1])
@@ -96,11 +100,13 @@ export default function Imagery() {
     }
 
     useEffect(() => {
-        const interval = setInterval(() => {
-            getData()
-        }, rate)
-        return () => clearInterval(interval)
-    }, [mute, rate])
+        // show the latest row straight away, then follow the live stream
+        getData()
+        return subscribeTelemetry(record => {
+            // id and the imagery columns of a data row
+            update({ data: [record[0], ...record.slice(8, 14)] })
+        })
+    }, [mute])
 
     useEffect(() => {
         if (mute) {
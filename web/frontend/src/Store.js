@@ -7,21 +7,12 @@ const mute = createSlice({
         toggleMute: state => !state
     }
 })
-const rate = createSlice({
-    name: 'rate',
-    initialState: 1000,
-    reducers: {
-        setRate: (_, action) => action.payload
-    }
-})
 
 const Store = configureStore({
     reducer: {
-        mute: mute.reducer,
-        rate: rate.reducer
+        mute: mute.reducer
     }
 })
 
 export const { toggleMute } = mute.actions
-export const { setRate } = rate.actions
 export default Store
\ No newline at end of file
@@ -3,4 +3,16 @@ export function getServerURL() {
     let url = new URL('http://127.0.0.1')
     url.port = 5000
     return url
-}
\ No newline at end of file
+}
+
+// Subscribe to telemetry rows pushed by the server as they are sampled.
+// The browser reconnects on its own and resumes after the last row it got.
+// Returns a function that closes the stream.
+export function subscribeTelemetry(onRecord) {
+    const url = getServerURL()
+    url.pathname = '/stream/telemetry'
+    const source = new EventSource(url)
+    source.onmessage = e => onRecord(JSON.parse(e.data))
+    source.onerror = e => console.error("Telemetry stream error", e)
+    return () => source.close()
+}